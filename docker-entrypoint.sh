@@ -12,6 +12,12 @@ fi
 
 if [[ "$1" = "celery" ]]
 then
+  # Metrics shared by the worker processes, starting empty
+  if [[ -n "$PROMETHEUS_MULTIPROC_DIR" ]]
+  then
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+    rm -f "$PROMETHEUS_MULTIPROC_DIR"/*.db
+  fi
   exec celery -A pypistats.extensions.celery worker -l info --concurrency=1
 fi
 
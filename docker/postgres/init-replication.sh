@@ -0,0 +1,3 @@
+#!/bin/bash
+# Let the postgresql-replica service stream the WAL of the primary
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -1,5 +1,27 @@
+import glob
 import os
 
+# Worker type: "sync" runs one request per process, "gevent" serves many concurrent
+# requests per process while they wait on PostgreSQL, Redis or PyPI
+worker_class = os.environ.get("WEB_WORKER_CLASS", "sync")
+
+if worker_class == "gevent":
+    # Patch before the app is preloaded, so its modules and psycopg2 cooperate with gevent
+    from gevent import monkey
+
+    monkey.patch_all()
+
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
+
+# Metrics shared by the workers, starting empty
+multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+if multiproc_dir:
+    os.makedirs(multiproc_dir, exist_ok=True)
+    for name in glob.glob(os.path.join(multiproc_dir, "*.db")):
+        os.remove(name)
+
 # Server socket
 # Check if we should bind to Unix socket (for Cabotage) or TCP port
 if os.environ.get("BIND_UNIX_SOCKET"):
@@ -11,8 +33,7 @@ else:
 
 # Worker processes
 workers = int(os.environ.get("WEB_CONCURRENCY", 2))
-worker_class = "sync"
-worker_connections = 1000
+worker_connections = int(os.environ.get("WEB_WORKER_CONNECTIONS", 1000))
 max_requests = 1000
 max_requests_jitter = 50
 preload_app = True
@@ -37,3 +58,10 @@ pidfile = None
 user = None
 group = None
 tmp_upload_dir = None
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of a worker that exited."""
+    from pypistats.metrics import mark_process_dead
+
+    mark_process_dead(worker.pid)
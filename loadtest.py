@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Load test for comparing web worker configurations.
+
+Runs a fixed number of concurrent clients against a running server for a
+fixed duration and reports the throughput and latency percentiles. Compare
+worker classes at the same core count, for example with ``WEB_CONCURRENCY=1``
+under ``taskset -c 0``, once with ``WEB_WORKER_CLASS=sync`` and once with
+``WEB_WORKER_CLASS=gevent``. The per-IP rate limits apply to the load test
+too, so run it against a server with rate limiting disabled.
+"""
+
+import argparse
+import itertools
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Default mix of pages and API responses
+PATHS = (
+    "/packages/numpy",
+    "/packages/requests",
+    "/api/packages/numpy/recent",
+    "/api/packages/requests/overall",
+    "/api/packages/django/python_minor",
+    "/top",
+)
+
+
+def run_client(base_url, paths, deadline, timeout):
+    """Request the paths in turn until the deadline, returning the latencies and the number of errors."""
+    session = requests.Session()
+    latencies = []
+    errors = 0
+    for path in itertools.cycle(paths):
+        if time.monotonic() >= deadline:
+            break
+        start = time.monotonic()
+        try:
+            response = session.get(base_url + path, timeout=timeout)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        latencies.append(time.monotonic() - start)
+        errors += not ok
+    return latencies, errors
+
+
+def percentile(values, percent):
+    """Get a percentile of sorted values."""
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a running pypistats server")
+    parser.add_argument("base_url", help="Server URL, e.g. http://localhost:5000")
+    parser.add_argument("--concurrency", type=int, default=50, help="Number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run for")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for each response")
+    parser.add_argument("--path", action="append", dest="paths", help="Path to request (repeatable)")
+    args = parser.parse_args()
+
+    base_url = args.base_url.rstrip("/")
+    paths = args.paths or PATHS
+    # Start the clients at different paths so the mix is even
+    offsets = [paths[i % len(paths) :] + paths[: i % len(paths)] for i in range(args.concurrency)]
+
+    start = time.monotonic()
+    deadline = start + args.duration
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(lambda p: run_client(base_url, p, deadline, args.timeout), offsets))
+    elapsed = time.monotonic() - start
+
+    latencies = sorted(itertools.chain.from_iterable(r[0] for r in results))
+    errors = sum(r[1] for r in results)
+    if not latencies:
+        print("No requests completed")
+        return
+    print(f"Requests:   {len(latencies)} in {elapsed:.1f}s with {args.concurrency} clients, {errors} errors")
+    print(f"Throughput: {len(latencies) / elapsed:.1f} requests/s")
+    print(
+        f"Latency:    mean {statistics.mean(latencies) * 1000:.0f}ms, "
+        f"p50 {percentile(latencies, 50) * 1000:.0f}ms, "
+        f"p95 {percentile(latencies, 95) * 1000:.0f}ms, "
+        f"p99 {percentile(latencies, 99) * 1000:.0f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
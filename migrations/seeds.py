@@ -7,10 +7,12 @@ import sys
 from pypistats.application import create_app
 from pypistats.application import db
 from pypistats.models.download import OverallDownloadCount
+from pypistats.models.download import PackageDownloadDate
 from pypistats.models.download import PythonMajorDownloadCount
 from pypistats.models.download import PythonMinorDownloadCount
 from pypistats.models.download import RecentDownloadCount
 from pypistats.models.download import SystemDownloadCount
+from pypistats.tasks.pypi import update_top_stats
 
 # required to use the db models outside of the context of the app
 app = create_app()
@@ -47,6 +49,9 @@ records = []
 for package in packages + ["__all__"]:
     print("Seeding: " + package)
 
+    if package != "__all__":
+        records.append(PackageDownloadDate(package=package, last_date=end_date))
+
     for idx, category in enumerate(["day", "week", "month"]):
         record = RecentDownloadCount(
             package=package, category=category, downloads=baseline * (idx + 1) + random.randint(-100, 100)
@@ -93,3 +98,6 @@ for package in packages + ["__all__"]:
 # push to the local database
 db.session.bulk_save_objects(records)
 db.session.commit()
+
+# rank the seeded packages for the top pages
+update_top_stats(str(end_date))
@@ -0,0 +1,57 @@
+"""Canonicalize package names
+
+Revision ID: b52d8e0f3a17
+Revises: e41b7d09c8a6
+Create Date: 2026-10-19 01:15:30.204117
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b52d8e0f3a17"
+down_revision = "e41b7d09c8a6"
+branch_labels = None
+depends_on = None
+
+# PEP 503 normalization, matching pypistats.names.canonicalize_name
+CANONICAL = "lower(regexp_replace(package, '[-_.]+', '-', 'g'))"
+NOT_CANONICAL = f"package != '__all__' AND package != {CANONICAL}"
+
+
+def merge(table, key, value):
+    """Move rows to their canonical name, summing into any existing row."""
+    columns = ", ".join(key)
+    selected = ", ".join(CANONICAL if column == "package" else column for column in key)
+    group_by = ", ".join(str(x + 1) for x in range(len(key)))
+    op.execute(
+        f"""
+        WITH moved AS (
+            DELETE FROM {table} WHERE {NOT_CANONICAL} RETURNING {columns}, {value}
+        )
+        INSERT INTO {table} ({columns}, {value})
+        SELECT {selected}, sum({value}) FROM moved GROUP BY {group_by}
+        ON CONFLICT ({columns}) DO UPDATE SET {value} = {table}.{value} + EXCLUDED.{value}
+        """
+    )
+
+
+def upgrade():
+    for table in ("overall", "python_major", "python_minor", "system"):
+        merge(table, ("date", "package", "category"), "downloads")
+    merge("recent", ("package", "category"), "downloads")
+    op.execute(
+        """
+        UPDATE users SET favorites = ARRAY(
+            SELECT DISTINCT lower(regexp_replace(favorite, '[-_.]+', '-', 'g'))
+            FROM unnest(favorites) AS favorite ORDER BY 1
+        )
+        WHERE favorites IS NOT NULL
+        """
+    )
+    # The top table is rebuilt from the canonical rows by the next ETL run
+
+
+def downgrade():
+    # The original spellings are not kept, so there is nothing to restore
+    pass
@@ -4,19 +4,33 @@ from celery import Task
 from flask import Flask
 
 from pypistats import views
+from pypistats.compression import compress_response
 from pypistats.config import DevConfig
 from pypistats.extensions import celery
 from pypistats.extensions import db
 from pypistats.extensions import github
 from pypistats.extensions import migrate
+from pypistats.metrics import init_metrics
+from pypistats.profiling import init_profiling
+from pypistats.ratelimit import api_keys_cli
+from pypistats.serialization import JSONProvider
+from pypistats.timing import init_timing
+from pypistats.tracing import init_app as init_tracing
 
 
 def create_app(config_object=DevConfig):
     """Create the application."""
     app = Flask(__name__.split(".")[0])
+    app.json = JSONProvider(app)
     app.config.from_object(config_object)
+    init_timing(app)
+    init_tracing(app)
     register_extensions(app)
+    init_metrics(app)
     register_blueprints(app)
+    register_commands(app)
+    app.after_request(compress_response)
+    init_profiling(app)
     init_celery(celery, app)
     return app
 
@@ -44,6 +58,11 @@ def register_blueprints(app):
     app.register_blueprint(views.user.blueprint)
 
 
+def register_commands(app):
+    """Register Flask CLI commands."""
+    app.cli.add_command(api_keys_cli)
+
+
 def register_extensions(app):
     """Register Flask extensions."""
     db.init_app(app)
@@ -0,0 +1,49 @@
+"""Bloom filter for package names."""
+
+import hashlib
+import math
+import struct
+
+# Header holding the number of bits and hash functions
+HEADER = struct.Struct(">QB")
+
+
+class BloomFilter:
+    """Compact set membership test with no false negatives.
+
+    A name that was added is always reported as present, while a name that
+    was not is reported as present with probability ``error_rate``.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """Create instance sized for capacity names."""
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, name):
+        """Get the bit positions of a name by double hashing."""
+        digest = hashlib.blake2b(name.encode(), digest_size=16).digest()
+        first, second = struct.unpack(">QQ", digest)
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, name):
+        """Add a name."""
+        for position in self._positions(name):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, name):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(name))
+
+    def to_bytes(self):
+        """Serialize the filter."""
+        return HEADER.pack(self.size, self.hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Deserialize a filter."""
+        bloom = cls.__new__(cls)
+        bloom.size, bloom.hashes = HEADER.unpack_from(data)
+        bloom.bits = bytearray(data[HEADER.size :])
+        return bloom
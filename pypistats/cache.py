@@ -0,0 +1,372 @@
+"""Response caches of the web workers."""
+
+import gzip
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+
+import redis
+from flask import current_app
+from flask import g
+from flask import make_response
+from flask import request
+from flask import session
+
+from pypistats.compression import CACHE_GZIP_LEVEL
+from pypistats.compression import set_encoded_body
+from pypistats.generation import get_generation
+from pypistats.names import canonicalize_name
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+# Prefix of the cache keys in redis
+KEY_PREFIX = "pypistats:cache"
+
+# Hash of the lookup and miss counts per endpoint
+STATS_KEY = f"{KEY_PREFIX}:stats"
+
+# Seconds to wait on redis before computing the response instead
+SOCKET_TIMEOUT = 0.25
+
+# Seconds a worker may hold the lock on computing a response
+LOCK_TIMEOUT = 60
+
+# Deletes the lock on computing a response only if it still has the token of the request that took it
+RELEASE_SCRIPT = """if redis.call("get", KEYS[1]) == ARGV[1] then return redis.call("del", KEYS[1]) end return 0"""
+
+# Seconds to wait for a response computed by another request
+WAIT_TIMEOUT = 10
+
+# Seconds between checks for a response computed by another worker
+POLL_INTERVAL = 0.05
+
+# Redis clients by url
+_clients = {}
+
+# Cache of the hottest responses in this worker
+_local = {"cache": None}
+
+# Events set when the responses being computed by this worker are cached
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+class LocalCache:
+    """Least recently used cache of compressed responses in this worker, bounded by their size in bytes.
+
+    The entries belong to a single generation of the data: the first lookup
+    for a newer generation empties the cache.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.generation = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key, generation):
+        """Get the mimetype and compressed body cached for a key, or None."""
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.size = 0
+                self.generation = generation
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[:2]
+
+    def put(self, key, generation, mimetype, body):
+        """Cache the mimetype and compressed body of a response, evicting the least recently used."""
+        size = len(key) + len(body)
+        if size > self.max_size:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = (mimetype, body, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted[2]
+                self.stats["evictions"] += 1
+
+    def get_stats(self):
+        """Get the hit ratio and occupancy of the cache."""
+        with self.lock:
+            stats = dict(self.stats, entries=len(self.entries), size=self.size, max_size=self.max_size)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else None
+        return stats
+
+
+def get_local_cache():
+    """Get the cache of this worker, or None if it is disabled."""
+    if _local["cache"] is None:
+        max_size = current_app.config["LOCAL_CACHE_SIZE"]
+        if not max_size:
+            return None
+        _local["cache"] = LocalCache(max_size)
+    return _local["cache"]
+
+
+def get_client():
+    """Get the redis client of the cache, or None if the cache is disabled."""
+    url = current_app.config["CACHE_URL"]
+    if not url:
+        return None
+    client = _clients.get(url)
+    if client is None:
+        if url == "memory://":
+            # In-process stand-in for development and tests
+            client = fakeredis.FakeRedis()
+        else:
+            client = redis.Redis.from_url(url, socket_timeout=SOCKET_TIMEOUT, socket_connect_timeout=SOCKET_TIMEOUT)
+        _clients[url] = client
+    return client
+
+
+def skip_cache():
+    """Leave the response of the current request out of the caches."""
+    g.skip_cache = True
+
+
+def get_key(generation):
+    """Get the cache key of the current request, or None if it can not be shared."""
+    if request.method not in ("GET", "HEAD"):
+        return None
+    # Profiled requests are computed
+    if "profiler" in g:
+        return None
+    # Pages for signed in users and pages with flashed messages are personal
+    if session.get("user_id") is not None or "_flashes" in session:
+        return None
+    view_args = dict(request.view_args or {})
+    if "package" in view_args:
+        view_args["package"] = canonicalize_name(view_args["package"])
+    path = urlencode(sorted(view_args.items()))
+    query = urlencode(sorted(request.args.items(multi=True)))
+    return f"{KEY_PREFIX}:{generation}:{request.endpoint}:{path}:{query}"
+
+
+def sets_cookie(response):
+    """Check whether a response sets a cookie, such as a session holding a new CSRF token, making it personal."""
+    return session.modified or "Set-Cookie" in response.headers
+
+
+def dump(mimetype, body):
+    """Serialize the mimetype and compressed body of a response."""
+    return mimetype.encode() + b"\n" + body
+
+
+def load(entry):
+    """Deserialize the mimetype and compressed body of a response from the cache."""
+    mimetype, body = entry.split(b"\n", 1)
+    return mimetype.decode(), body
+
+
+def accepts_gzip():
+    """Check whether the client of the current request accepts gzip compressed responses."""
+    return bool(request.accept_encodings.quality("gzip"))
+
+
+def respond(mimetype, body, status):
+    """Make a response from a cached body, sent as it is to clients accepting gzip."""
+    response = current_app.response_class(mimetype=mimetype)
+    if accepts_gzip():
+        set_encoded_body(response, body, "gzip")
+    else:
+        response.set_data(gzip.decompress(body))
+        response.vary.add("Accept-Encoding")
+    response.headers["X-Cache"] = status
+    return response
+
+
+def lookup(key, generation, local, client, count=True):
+    """Get a response from the caches, or None."""
+    if local is not None:
+        entry = local.get(key, generation)
+        if entry is not None:
+            return respond(*entry, "HIT-LOCAL")
+    if client is None:
+        return None
+    pipe = client.pipeline(transaction=False)
+    pipe.get(key)
+    if count:
+        pipe.hincrby(STATS_KEY, f"{request.endpoint}:lookups", 1)
+    entry = pipe.execute()[0]
+    if entry is None:
+        return None
+    mimetype, body = load(entry)
+    if local is not None:
+        local.put(key, generation, mimetype, body)
+    return respond(mimetype, body, "HIT")
+
+
+def store(key, generation, local, client, response):
+    """Add a computed response to the caches, returning its compressed body if it is cacheable."""
+    body = None
+    if (
+        response.status_code == 200
+        and not response.is_streamed
+        and not g.get("skip_cache")
+        and not sets_cookie(response)
+    ):
+        body = gzip.compress(response.get_data(), compresslevel=CACHE_GZIP_LEVEL, mtime=0)
+    if body is not None and local is not None:
+        local.put(key, generation, response.mimetype, body)
+    if client is None:
+        return body
+    endpoint = request.endpoint
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.hincrby(STATS_KEY, f"{endpoint}:misses", 1)
+        if body is not None:
+            entry = dump(response.mimetype, body)
+            if len(entry) <= current_app.config["CACHE_MAX_ENTRY_SIZE"]:
+                pipe.set(key, entry, ex=current_app.config["CACHE_TTL"])
+            else:
+                pipe.hincrby(STATS_KEY, f"{endpoint}:oversized", 1)
+        pipe.execute()
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Cache unavailable: {e}")
+    return body
+
+
+def wait(key, generation, local, client):
+    """Wait for another worker computing a response, serving the previous generation meanwhile if it is cached."""
+    if generation.previous_id is not None:
+        stale_key = get_key(generation.previous_id)
+        entry = client.get(stale_key) if stale_key is not None else None
+        if entry is not None:
+            return respond(*load(entry), "STALE")
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        response = lookup(key, generation.id, local, client, count=False)
+        if response is not None:
+            return response
+    return None
+
+
+def release(client, lock, token):
+    """Release a lock taken by this request, unless it expired and another request has taken it since."""
+    try:
+        client.register_script(RELEASE_SCRIPT)(keys=[lock], args=[token])
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Cache lock not released: {e}")
+
+
+def compute(view, args, kwargs, key, generation, local, client):
+    """Compute a response once across the workers sharing the cache."""
+    lock = f"{key}:lock"
+    token = None
+    if client is not None:
+        token = secrets.token_hex(16)
+        if not client.set(lock, token, nx=True, ex=LOCK_TIMEOUT):
+            token = None
+            response = wait(key, generation, local, client)
+            if response is not None:
+                return response
+    try:
+        response = make_response(view(*args, **kwargs))
+        response.headers["X-Cache"] = "MISS"
+        body = store(key, generation.id, local, client, response)
+        # Send the body compressed for the caches rather than compressing it again
+        if body is not None and accepts_gzip():
+            set_encoded_body(response, body, "gzip")
+        return response
+    finally:
+        if token is not None:
+            release(client, lock, token)
+
+
+def cached(view):
+    """Serve a view from the caches, keyed by the published generation of the data.
+
+    Responses are looked up in the cache of this worker first, then in the
+    cache shared through redis. Entries are never stale: a new generation
+    changes every key, and the old shared entries expire after ``CACHE_TTL``
+    seconds. Only successful responses of at most ``CACHE_MAX_ENTRY_SIZE``
+    compressed bytes that set no cookie are shared.
+
+    Entries are stored gzip compressed, and sent as they are to the clients
+    accepting gzip, so hits do no compression work.
+
+    On a miss only one request computes the response. Concurrent requests
+    in the same worker wait for it, and requests in other workers are served
+    the previous generation's response if it is still cached, or wait for
+    the response to be shared.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        generation = get_generation()
+        key = get_key(generation.id)
+        if key is None:
+            return view(*args, **kwargs)
+        local = get_local_cache()
+        client = get_client()
+
+        try:
+            response = lookup(key, generation.id, local, client)
+            if response is not None:
+                return response
+
+            with _inflight_lock:
+                done = _inflight.get(key)
+                leader = done is None
+                if leader:
+                    done = _inflight[key] = threading.Event()
+            if not leader:
+                done.wait(WAIT_TIMEOUT)
+                response = lookup(key, generation.id, local, client, count=False)
+                if response is not None:
+                    return response
+            try:
+                return compute(view, args, kwargs, key, generation, local, client)
+            finally:
+                if leader:
+                    with _inflight_lock:
+                        del _inflight[key]
+                    done.set()
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Cache unavailable: {e}")
+            return view(*args, **kwargs)
+
+    return wrapper
+
+
+def get_stats():
+    """Get the lookups, hits, misses and hit ratio of each endpoint in the shared cache."""
+    client = get_client()
+    if client is None:
+        return {}
+    stats = {}
+    for field, value in client.hgetall(STATS_KEY).items():
+        endpoint, name = field.decode().rsplit(":", 1)
+        stats.setdefault(endpoint, {"lookups": 0, "misses": 0, "oversized": 0})[name] = int(value)
+    for endpoint in stats.values():
+        endpoint["hits"] = endpoint["lookups"] - endpoint["misses"]
+        endpoint["hit_ratio"] = round(endpoint["hits"] / endpoint["lookups"], 4) if endpoint["lookups"] else None
+    return stats
+
+
+def get_local_stats():
+    """Get the hits, misses, evictions and size of the cache of this worker."""
+    local = get_local_cache()
+    return local.get_stats() if local is not None else {}
@@ -0,0 +1,137 @@
+"""Compression of responses in the encoding negotiated with the client.
+
+Usage: python -m pypistats.compression [PATH ...]
+"""
+
+import argparse
+import gzip
+import time
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Mimetypes of the responses worth compressing
+COMPRESSIBLE_MIMETYPES = (
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+    "text/css",
+    "text/csv",
+    "text/html",
+    "text/javascript",
+    "text/plain",
+)
+
+# Bodies smaller than this many bytes are sent uncompressed
+MIN_SIZE = 500
+
+# Level of the gzip compression of computed responses, within 1% of level 9 in size at 60% of its CPU time
+GZIP_LEVEL = 5
+
+# Quality of the brotli compression of computed responses, smaller than gzip level 9 at the CPU time of level 5
+BROTLI_QUALITY = 4
+
+# Level of the gzip compression of cached responses, which are compressed once and served many times
+CACHE_GZIP_LEVEL = 9
+
+# Pages measured by default
+MEASURED_PATHS = (
+    "/packages/numpy",
+    "/packages/__all__",
+    "/api/packages/numpy/overall",
+    "/api/packages/__all__/overall",
+)
+
+
+def get_encoding():
+    """Get the encoding preferred by the client of the current request, or None for an uncompressed response."""
+    accept = request.accept_encodings
+    gzip_quality = accept.quality("gzip")
+    brotli_quality = accept.quality("br") if brotli is not None else 0
+    if brotli_quality and brotli_quality >= gzip_quality:
+        return "br"
+    if gzip_quality:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    """Compress a body in an encoding at the level tuned for computed responses."""
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def set_encoded_body(response, body, encoding):
+    """Set the body of a response to a body compressed in an encoding."""
+    response.set_data(body)
+    response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+
+
+def compress_response(response):
+    """Compress a response in the encoding preferred by the client.
+
+    Responses that are already compressed, such as cached or pre-rendered
+    ones, are sent as they are.
+    """
+    if response.direct_passthrough or response.is_streamed or response.content_encoding:
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    body = response.get_data()
+    if len(body) < MIN_SIZE:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = get_encoding()
+    if encoding is not None:
+        set_encoded_body(response, compress(body, encoding), encoding)
+    return response
+
+
+def measure(body, compressor, repeat):
+    """Get the compressed size of a body and the CPU time of compressing it in microseconds."""
+    start = time.process_time()
+    for _ in range(repeat):
+        compressed = compressor(body)
+    return len(compressed), (time.process_time() - start) / repeat * 1e6
+
+
+def main():
+    from pypistats.run import app
+    from pypistats.run import limiter
+
+    parser = argparse.ArgumentParser(description="Measure the compressed size and CPU time of responses")
+    parser.add_argument("paths", nargs="*", default=MEASURED_PATHS, help="Paths of the responses to measure")
+    parser.add_argument("--repeat", type=int, default=100, help="Compressions to average each measurement over")
+    args = parser.parse_args()
+
+    encodings = {
+        f"gzip level {GZIP_LEVEL}": lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0),
+        f"gzip level {CACHE_GZIP_LEVEL} (cache)": lambda body: gzip.compress(
+            body, compresslevel=CACHE_GZIP_LEVEL, mtime=0
+        ),
+    }
+    if brotli is not None:
+        encodings[f"brotli quality {BROTLI_QUALITY}"] = lambda body: brotli.compress(body, quality=BROTLI_QUALITY)
+
+    limiter.enabled = False
+    client = app.test_client()
+    for path in args.paths:
+        response = client.get(path, headers={"Accept-Encoding": "identity"})
+        body = response.get_data()
+        print(f"{path}: {response.status_code}, {len(body)} bytes")
+        for name, compressor in encodings.items():
+            size, cpu = measure(body, compressor, args.repeat)
+            print(f"  {name}: {size} bytes ({size / max(len(body), 1):.1%}), {cpu:.0f}us CPU")
+        compressed = gzip.compress(body, compresslevel=CACHE_GZIP_LEVEL, mtime=0)
+        _, cpu = measure(compressed, gzip.decompress, args.repeat)
+        print(f"  cache hit for a client without gzip: {cpu:.0f}us CPU to decompress")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Conditional HTTP caching keyed to the published generation of the data."""
+
+import datetime
+
+from flask import current_app
+from flask import g
+from flask import request
+from flask import session
+
+from pypistats.extensions import celery
+from pypistats.generation import get_generation
+
+# Request methods whose responses can be revalidated
+CACHEABLE_METHODS = ("GET", "HEAD")
+
+# Endpoints that are always computed, such as pages with a CSRF token in a form
+UNCACHED_ENDPOINTS = ("general.health", "general.index", "general.search")
+
+# Longest freshness lifetime in seconds, so caches revalidate soon after a publish even while the ETL is running
+MAX_AGE = 3600
+
+
+def get_max_age():
+    """Get the number of seconds until the next scheduled ETL run, at most ``MAX_AGE``.
+
+    The data is published some time after the run starts, so a response
+    served in between must not stay fresh until the next run.
+    """
+    schedule = celery.conf.beat_schedule["update_db"]["schedule"]
+    remaining = schedule.remaining_estimate(datetime.datetime.now(datetime.timezone.utc))
+    return min(max(int(remaining.total_seconds()), 0), MAX_AGE)
+
+
+def get_etag(generation):
+    """Get the entity tag of the current request, or None if it can not be cached."""
+    if request.method not in CACHEABLE_METHODS or request.endpoint in UNCACHED_ENDPOINTS:
+        return None
+    # Pages of signed in users show their favorites, which change without a publish
+    if not generation.id or "_flashes" in session or session.get("user_id") is not None:
+        return None
+    return f"{generation.date}-{generation.run_id or generation.id}"
+
+
+def get_last_modified(generation):
+    """Get the time the generation was published, at the precision of HTTP dates."""
+    return generation.published_at.replace(microsecond=0, tzinfo=datetime.timezone.utc)
+
+
+def set_cache_headers(response, etag, generation):
+    """Set the validators and freshness lifetime of a response."""
+    response.set_etag(etag, weak=True)
+    response.last_modified = get_last_modified(generation)
+    response.cache_control.public = True
+    response.cache_control.max_age = get_max_age()
+    return response
+
+
+def not_modified():
+    """Answer a conditional request with 304 if the data has not been published again since."""
+    generation = get_generation()
+    etag = get_etag(generation)
+    if etag is None:
+        return None
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        since = request.if_modified_since
+        fresh = since is not None and since >= get_last_modified(generation)
+    if fresh:
+        return set_cache_headers(current_app.response_class(status=304), etag, generation)
+    return None
+
+
+def add_cache_headers(response):
+    """Add the cache headers to a successful response."""
+    # Pages of signed in users are revalidated on each use, as the favorite and logout links change without a
+    # publish, and responses setting a cookie, such as a new session, must not be stored by shared caches
+    if session.get("user_id") is not None or session.modified or "Set-Cookie" in response.headers:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    # A response of the previous generation is served while the current one is computed
+    if response.status_code == 200 and response.headers.get("X-Cache") != "STALE" and not g.get("skip_cache"):
+        generation = get_generation()
+        etag = get_etag(generation)
+        if etag is not None:
+            set_cache_headers(response, etag, generation)
+    return response
@@ -5,6 +5,8 @@ import os
 from celery.schedules import crontab
 from flask import json
 
+from pypistats.replicas import get_replica_binds
+
 
 def get_db_uri():
     """Get the database URI."""
@@ -18,7 +20,7 @@ class Config:
     # Celery 5.x configuration
     broker_url = os.environ.get("REDIS_URL", "redis://redis:6379/0")
     broker_transport_options = {"visibility_timeout": 86400}
-    imports = ["pypistats.tasks.pypi", "pypistats.tasks.backfill"]
+    imports = ["pypistats.tasks.pypi", "pypistats.tasks.backfill", "pypistats.tasks.warm"]
     beat_schedule = {
         "update_db": {"task": "pypistats.tasks.pypi.etl", "schedule": crontab(minute=0, hour=1)}  # 1am UTC
     }
@@ -32,6 +34,45 @@ class Config:
     SECRET_KEY = os.environ.get("PYPISTATS_SECRET", "secret-key")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_DATABASE_URI = get_db_uri()
+    # Read replicas for the read-only pages and API endpoints
+    SQLALCHEMY_BINDS = get_replica_binds(os.environ.get("DATABASE_REPLICA_URLS", ""))
+    # Seconds between checks of the replicas, and the replication lag at which reads fall back to the primary
+    REPLICA_CHECK_INTERVAL = int(os.environ.get("REPLICA_CHECK_INTERVAL", 10))
+    REPLICA_MAX_LAG = int(os.environ.get("REPLICA_MAX_LAG", 60))
+    # Seconds between checks for data published by the ETL
+    PUBLISH_POLL_INTERVAL = int(os.environ.get("PUBLISH_POLL_INTERVAL", 30))
+    # Rate limits shared by the web workers through redis, per client address or API key
+    RATELIMIT_STORAGE_URI = os.environ.get("RATELIMIT_STORAGE_URI", broker_url)
+    RATELIMIT_STRATEGY = "sliding-window-counter"
+    RATELIMIT_IN_MEMORY_FALLBACK_ENABLED = True
+    RATELIMIT_TIERS = {
+        "default": "5 per second;30 per minute",
+        "standard": "10 per second;300 per minute",
+        "bulk": "50 per second;3000 per minute",
+    }
+    # Redis url of the shared response cache, empty to disable it
+    CACHE_URL = os.environ.get("CACHE_URL", broker_url)
+    # Seconds to keep cache entries of old generations of the data
+    CACHE_TTL = int(os.environ.get("CACHE_TTL", 2 * 86400))
+    # Largest compressed response to cache, in bytes
+    CACHE_MAX_ENTRY_SIZE = int(os.environ.get("CACHE_MAX_ENTRY_SIZE", 1024 * 1024))
+    # Bytes of responses cached in the memory of each web worker, 0 to disable it
+    LOCAL_CACHE_SIZE = int(os.environ.get("LOCAL_CACHE_SIZE", 32 * 1024 * 1024))
+    # Directory of the pre-rendered package pages, empty to disable them
+    PRERENDER_DIR = os.environ.get("PRERENDER_DIR", "")
+    # Number of most downloaded packages to pre-render, 0 for all
+    PRERENDER_PACKAGES = int(os.environ.get("PRERENDER_PACKAGES", 1000))
+    # PyPI JSON API and the seconds before package metadata from it is refreshed
+    PYPI_URL = os.environ.get("PYPI_URL", "https://pypi.org/pypi")
+    METADATA_MAX_AGE = int(os.environ.get("METADATA_MAX_AGE", 86400))
+    # Server-Timing headers on every response, and the seconds above which requests are logged as slow
+    REQUEST_TIMING = bool(int(os.environ.get("REQUEST_TIMING", 0)))
+    SLOW_REQUEST_THRESHOLD = float(os.environ.get("SLOW_REQUEST_THRESHOLD", 1))
+    # Span exporter of the web and Celery processes, empty to disable tracing, and the file of the file exporter
+    TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "")
+    TRACING_FILE = os.environ.get("TRACING_FILE", "traces.jsonl")
+    # Directory of the profiles of requests and tasks, empty to only return the profiles of requests
+    PROFILE_DIR = os.environ.get("PROFILE_DIR", "")
 
     # Plotly chart definitions
     PLOT_BASE = json.load(open(os.path.join(os.path.dirname(__file__), "plots", "plot_base.json")))
@@ -66,6 +107,10 @@ class TestConfig(Config):
     ENV = "dev"
     TESTING = True
     WTF_CSRF_ENABLED = False  # Allows form testing
+    CACHE_URL = "memory://"
+    RATELIMIT_STORAGE_URI = "memory://"
+    # Answered by the PyPI stub of the tests rather than PyPI
+    PYPI_URL = "http://pypi.test/pypi"
 
 
 configs = {"development": DevConfig, "local": LocalConfig, "production": ProdConfig, "test": TestConfig}
@@ -0,0 +1,278 @@
+"""Query, table and index statistics of the PostgreSQL database, and their changes between snapshots.
+
+The query statistics need the ``pg_stat_statements`` extension: add it to
+``shared_preload_libraries`` and run ``CREATE EXTENSION pg_stat_statements``
+in the database. Without it the report only has the table and index
+statistics.
+
+The statistics are counters since the last reset of the server's
+statistics, so the difference between two snapshots gives the load of the
+database in between, such as before and after a deploy.
+
+Each server keeps its own statistics, so they are collected from the primary
+and from each read replica in ``SQLALCHEMY_BINDS`` separately.
+"""
+
+import datetime
+import math
+
+import sqlalchemy as sa
+from flask import current_app
+
+from pypistats.extensions import db
+from pypistats.models.snapshot import DbStatsSnapshot
+
+# Name of the primary database server in the statistics, the replicas being named by their bind key
+PRIMARY = "primary"
+
+# Statements kept in a snapshot, by total time
+SNAPSHOT_STATEMENTS = 1000
+
+# Characters of the text of a statement kept in a snapshot
+QUERY_LENGTH = 2000
+
+# Statements listed in a report, by total and by mean time
+REPORT_STATEMENTS = 20
+
+# Bytes of the header of a page
+PAGE_HEADER = 24
+
+# Bytes of the header and line pointer of a table row and of an index entry
+ROW_OVERHEAD = 28
+INDEX_ENTRY_OVERHEAD = 12
+
+# Part of a page filled by a table row and by an index entry at the default fillfactor
+TABLE_FILL = 1.0
+INDEX_FILL = 0.9
+
+DATABASE_QUERY = sa.text(
+    "SELECT blks_hit, blks_read, xact_commit, xact_rollback, temp_bytes, deadlocks, stats_reset, "
+    "current_setting('block_size')::int AS block_size "
+    "FROM pg_stat_database WHERE datname = current_database()"
+)
+
+STATEMENTS_QUERY = sa.text(
+    "SELECT queryid, left(min(query), :length) AS query, sum(calls)::bigint AS calls, "
+    "sum(total_exec_time) AS total_ms, sum(rows)::bigint AS rows, sum(shared_blks_hit)::bigint AS shared_blks_hit, "
+    "sum(shared_blks_read)::bigint AS shared_blks_read, sum(temp_blks_written)::bigint AS temp_blks_written "
+    "FROM pg_stat_statements "
+    "WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database()) AND queryid IS NOT NULL "
+    "GROUP BY queryid ORDER BY total_ms DESC LIMIT :limit"
+)
+
+TABLES_QUERY = sa.text(
+    "SELECT t.relname AS name, t.seq_scan, t.seq_tup_read, coalesce(t.idx_scan, 0) AS idx_scan, "
+    "coalesce(t.idx_tup_fetch, 0) AS idx_tup_fetch, t.n_live_tup, t.n_dead_tup, "
+    "coalesce(io.heap_blks_hit, 0) AS heap_blks_hit, coalesce(io.heap_blks_read, 0) AS heap_blks_read, "
+    "coalesce(io.idx_blks_hit, 0) AS idx_blks_hit, coalesce(io.idx_blks_read, 0) AS idx_blks_read, "
+    "pg_relation_size(t.relid) AS size, pg_total_relation_size(t.relid) AS total_size, "
+    "greatest(t.last_vacuum, t.last_autovacuum) AS last_vacuum, "
+    "greatest(t.last_analyze, t.last_autoanalyze) AS last_analyze "
+    "FROM pg_stat_user_tables t JOIN pg_statio_user_tables io ON io.relid = t.relid "
+    "WHERE t.schemaname = current_schema()"
+)
+
+INDEXES_QUERY = sa.text(
+    "SELECT i.indexrelname AS name, i.relname AS table, i.idx_scan, i.idx_tup_read, "
+    "coalesce(io.idx_blks_hit, 0) AS idx_blks_hit, coalesce(io.idx_blks_read, 0) AS idx_blks_read, "
+    "pg_relation_size(i.indexrelid) AS size "
+    "FROM pg_stat_user_indexes i JOIN pg_statio_user_indexes io ON io.indexrelid = i.indexrelid "
+    "WHERE i.schemaname = current_schema()"
+)
+
+# Average width in bytes of the columns of each table and index, as sampled by ANALYZE
+TABLE_WIDTHS_QUERY = sa.text(
+    "SELECT tablename, sum(avg_width) FROM pg_stats WHERE schemaname = current_schema() GROUP BY tablename"
+)
+INDEX_WIDTHS_QUERY = sa.text(
+    "SELECT ic.relname, sum(s.avg_width) FROM pg_index i "
+    "JOIN pg_class ic ON ic.oid = i.indexrelid "
+    "JOIN pg_class tc ON tc.oid = i.indrelid "
+    "JOIN pg_namespace n ON n.oid = tc.relnamespace "
+    "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+    "JOIN pg_stats s ON s.schemaname = current_schema() AND s.tablename = tc.relname AND s.attname = a.attname "
+    "WHERE n.nspname = current_schema() "
+    "GROUP BY ic.relname"
+)
+
+# Counters of each section of the statistics, subtracted between snapshots
+COUNTERS = {
+    "database": ("blks_hit", "blks_read", "xact_commit", "xact_rollback", "temp_bytes", "deadlocks"),
+    "statements": ("calls", "total_ms", "rows", "shared_blks_hit", "shared_blks_read", "temp_blks_written"),
+    "tables": (
+        "seq_scan",
+        "seq_tup_read",
+        "idx_scan",
+        "idx_tup_fetch",
+        "heap_blks_hit",
+        "heap_blks_read",
+        "idx_blks_hit",
+        "idx_blks_read",
+    ),
+    "indexes": ("idx_scan", "idx_tup_read", "idx_blks_hit", "idx_blks_read"),
+}
+
+# Key of the rows of each section
+ROW_KEYS = {"statements": "queryid", "tables": "name", "indexes": "name"}
+
+
+def to_json(row):
+    """Convert a result row to a dict of JSON values."""
+    values = dict(row._mapping)
+    for key, value in values.items():
+        if isinstance(value, datetime.datetime):
+            values[key] = value.isoformat()
+    return values
+
+
+def estimate_bloat(size, rows, width, overhead, fill, block_size):
+    """Estimate the bytes of a table or index beyond what its live rows need, or None before it is analyzed."""
+    if width is None:
+        return None
+    per_page = max(int((block_size - PAGE_HEADER) * fill // (width + overhead)), 1)
+    needed = max(math.ceil(rows / per_page), 1) * block_size
+    return max(size - needed, 0)
+
+
+def get_statements(connection):
+    """Get the statistics of the statements of the database, or None without pg_stat_statements."""
+    try:
+        with connection.begin_nested():
+            result = connection.execute(STATEMENTS_QUERY, {"length": QUERY_LENGTH, "limit": SNAPSHOT_STATEMENTS})
+            return [to_json(row) for row in result]
+    except sa.exc.DBAPIError as e:
+        current_app.logger.warning(f"pg_stat_statements is not available: {str(e.orig).splitlines()[0]}")
+        return None
+
+
+def get_servers():
+    """Get the engines of the primary and of each bind in ``SQLALCHEMY_BINDS``, by server name."""
+    binds = {key: engine for key, engine in db.engines.items() if key is not None}
+    return {PRIMARY: db.engine, **dict(sorted(binds.items()))}
+
+
+def collect_stats(server=PRIMARY):
+    """Collect the current statistics of a database server."""
+    with get_servers()[server].connect() as connection:
+        database = to_json(connection.execute(DATABASE_QUERY).one())
+        tables = [to_json(row) for row in connection.execute(TABLES_QUERY)]
+        indexes = [to_json(row) for row in connection.execute(INDEXES_QUERY)]
+        table_widths = dict(connection.execute(TABLE_WIDTHS_QUERY).all())
+        index_widths = dict(connection.execute(INDEX_WIDTHS_QUERY).all())
+        statements = get_statements(connection)
+
+    block_size = database.pop("block_size")
+    live_rows = {}
+    for table in tables:
+        live_rows[table["name"]] = table["n_live_tup"]
+        table["bloat"] = estimate_bloat(
+            table["size"], table["n_live_tup"], table_widths.get(table["name"]), ROW_OVERHEAD, TABLE_FILL, block_size
+        )
+    for index in indexes:
+        index["bloat"] = estimate_bloat(
+            index["size"],
+            live_rows.get(index["table"], 0),
+            index_widths.get(index["name"]),
+            INDEX_ENTRY_OVERHEAD,
+            INDEX_FILL,
+            block_size,
+        )
+    return {
+        "server": server,
+        "taken_at": datetime.datetime.utcnow().isoformat(),
+        "database": database,
+        "statements": statements,
+        "tables": tables,
+        "indexes": indexes,
+    }
+
+
+def take_snapshot(label=""):
+    """Save the current statistics of each database server as a snapshot, leaving out the unreachable replicas."""
+    data = {}
+    for server in get_servers():
+        try:
+            data[server] = collect_stats(server)
+        except sa.exc.OperationalError as e:
+            if server == PRIMARY:
+                raise
+            current_app.logger.warning(f"Statistics of {server} unavailable: {str(e.orig).splitlines()[0]}")
+    return DbStatsSnapshot.create(label=label, data=data)
+
+
+def subtract(new, old, counters):
+    """Get the change of the counters of a row since an older row.
+
+    A counter lower than before was reset in between, so all of its current
+    value is new.
+    """
+    row = dict(new)
+    if old is None:
+        return row
+    for counter in counters:
+        if new[counter] >= old[counter]:
+            row[counter] = new[counter] - old[counter]
+    return row
+
+
+def diff_stats(old, new):
+    """Get the change of the statistics of a database server between two collections of them."""
+    stats = {
+        "server": new["server"],
+        "taken_at": new["taken_at"],
+        "since": old["taken_at"],
+        "database": subtract(new["database"], old["database"], COUNTERS["database"]),
+    }
+    for section, key in ROW_KEYS.items():
+        if new[section] is None:
+            stats[section] = None
+            continue
+        old_rows = {row[key]: row for row in old[section] or []}
+        stats[section] = [subtract(row, old_rows.get(row[key]), COUNTERS[section]) for row in new[section]]
+    return stats
+
+
+def hit_ratio(hits, reads):
+    """Get the share of the blocks found in shared buffers, or None without any block."""
+    return hits / (hits + reads) if hits + reads else None
+
+
+def get_report(stats):
+    """Get the report of a collection of statistics or of the change between two of them."""
+    database = dict(
+        stats["database"], hit_ratio=hit_ratio(stats["database"]["blks_hit"], stats["database"]["blks_read"])
+    )
+    tables = []
+    for table in stats["tables"]:
+        heap_ratio = hit_ratio(table["heap_blks_hit"], table["heap_blks_read"])
+        index_ratio = hit_ratio(table["idx_blks_hit"], table["idx_blks_read"])
+        tables.append(dict(table, heap_hit_ratio=heap_ratio, idx_hit_ratio=index_ratio))
+    indexes = [
+        dict(index, hit_ratio=hit_ratio(index["idx_blks_hit"], index["idx_blks_read"])) for index in stats["indexes"]
+    ]
+
+    by_total = by_mean = None
+    if stats["statements"] is not None:
+        statements = []
+        for statement in stats["statements"]:
+            if statement["calls"]:
+                statements.append(
+                    dict(
+                        statement,
+                        mean_ms=statement["total_ms"] / statement["calls"],
+                        hit_ratio=hit_ratio(statement["shared_blks_hit"], statement["shared_blks_read"]),
+                    )
+                )
+        by_total = sorted(statements, key=lambda s: s["total_ms"], reverse=True)[:REPORT_STATEMENTS]
+        by_mean = sorted(statements, key=lambda s: s["mean_ms"], reverse=True)[:REPORT_STATEMENTS]
+
+    return {
+        "server": stats["server"],
+        "taken_at": stats["taken_at"],
+        "since": stats.get("since"),
+        "database": database,
+        "by_total": by_total,
+        "by_mean": by_mean,
+        "tables": sorted(tables, key=lambda t: t["total_size"], reverse=True),
+        "indexes": sorted(indexes, key=lambda i: (i["table"], i["name"])),
+    }
@@ -7,8 +7,9 @@ from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 
 from pypistats.config import Config
+from pypistats.replicas import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 github = GitHub()
 migrate = Migrate()
 auth = HTTPBasicAuth()
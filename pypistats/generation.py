@@ -0,0 +1,36 @@
+"""Data generation published by the ETL."""
+
+import time
+from collections import namedtuple
+
+from flask import current_app
+
+from pypistats.models.publish import Publish
+
+Generation = namedtuple("Generation", ["id", "date", "published_at", "run_id", "previous_id"])
+
+# The latest generation seen by this worker and when it was last checked
+_latest = {"generation": None, "checked": None}
+
+
+def get_generation(refresh=False):
+    """Get the latest published generation of the data.
+
+    The publish table is checked at most once every ``PUBLISH_POLL_INTERVAL``
+    seconds per worker, unless ``refresh`` is set, so callers can use this on
+    every request to tell when data they hold in memory is out of date.
+    """
+    now = time.monotonic()
+    checked = _latest["checked"]
+    if refresh or checked is None or now - checked >= current_app.config["PUBLISH_POLL_INTERVAL"]:
+        publishes = Publish.query.order_by(Publish.id.desc()).limit(2).all()
+        if not publishes:
+            _latest["generation"] = Generation(0, None, None, None, None)
+        else:
+            publish = publishes[0]
+            previous_id = publishes[1].id if len(publishes) > 1 else None
+            _latest["generation"] = Generation(
+                publish.id, publish.date, publish.published_at, publish.run_id, previous_id
+            )
+        _latest["checked"] = now
+    return _latest["generation"]
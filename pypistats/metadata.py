@@ -0,0 +1,123 @@
+"""PyPI metadata of packages, cached and refreshed in the background."""
+
+import json
+import re
+import time
+
+import redis
+import requests
+from flask import current_app
+from kombu.exceptions import OperationalError
+
+from pypistats.cache import get_client
+from pypistats.cache import skip_cache
+from pypistats.timing import timer
+from pypistats.tracing import span
+
+# Cache key of the metadata of a package
+METADATA_KEY = "pypistats:metadata:{package}"
+
+# Key held while a refresh of the metadata of a package is queued
+REFRESH_KEY = "pypistats:metadata:{package}:refresh"
+
+# Seconds before a queued refresh may be queued again
+REFRESH_TIMEOUT = 300
+
+# Seconds to keep metadata that is no longer refreshed
+METADATA_TTL = 30 * 86400
+
+# Seconds to wait on PyPI
+FETCH_TIMEOUT = 5
+
+# Fields of the PyPI package info shown on the package page
+INFO_FIELDS = ("package_url", "home_page", "author", "license", "summary", "version")
+
+
+def parse_metadata(data):
+    """Keep the fields of PyPI package metadata used by the package page, with its dependencies parsed."""
+    info = data["info"]
+    requires, optional = set(), set()
+    for dependency in info.get("requires_dist") or ():
+        package_name = re.split(r"[^0-9a-zA-Z_.-]+", dependency.lower())[0]
+        if "; extra ==" in dependency:
+            optional.add(package_name)
+        else:
+            requires.add(package_name)
+    return {
+        "info": {field: info.get(field) for field in INFO_FIELDS},
+        "requires": sorted(requires),
+        "optional": sorted(optional),
+    }
+
+
+def fetch_metadata(package):
+    """Fetch the metadata of a package from PyPI, or None if PyPI does not know it."""
+    with timer("http"), span("pypi.fetch", package=package):
+        response = requests.get(f"{current_app.config['PYPI_URL']}/{package}/json", timeout=FETCH_TIMEOUT)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return parse_metadata(response.json())
+
+
+def refresh_metadata(package):
+    """Fetch the metadata of a package and store it in the cache.
+
+    Metadata that could not be fetched is not stored, so the next view
+    queues another refresh.
+    """
+    try:
+        metadata = fetch_metadata(package)
+    except Exception as e:
+        print(f"Error fetching metadata of {package}: {e}")
+        return None
+    client = get_client()
+    if client is not None:
+        entry = json.dumps({"fetched": time.time(), "metadata": metadata})
+        client.set(METADATA_KEY.format(package=package), entry, ex=METADATA_TTL)
+    return metadata
+
+
+def queue_refresh(client, package):
+    """Queue a background refresh of the metadata of a package, unless one is already queued."""
+    from pypistats.tasks.warm import refresh_package_metadata
+
+    if client.set(REFRESH_KEY.format(package=package), 1, nx=True, ex=REFRESH_TIMEOUT):
+        refresh_package_metadata.apply_async((package,), retry=False)
+
+
+def get_metadata(package, block=False):
+    """Get the cached metadata of a package.
+
+    Metadata older than ``METADATA_MAX_AGE`` seconds is returned while a
+    refresh is queued. Missing metadata is returned as None, and the response
+    is left out of the caches so the next view can show the refreshed
+    metadata. With ``block`` set, missing or old metadata is fetched from PyPI
+    instead, as the cache warming does.
+
+    Without the cache there is nowhere to keep refreshed metadata, so views
+    get None rather than waiting on PyPI.
+    """
+    client = get_client()
+    if client is None:
+        if block:
+            return refresh_metadata(package)
+        return None
+
+    entry = None
+    try:
+        entry = client.get(METADATA_KEY.format(package=package))
+        if entry is not None:
+            entry = json.loads(entry)
+            if time.time() - entry["fetched"] < current_app.config["METADATA_MAX_AGE"]:
+                return entry["metadata"]
+        if block:
+            return refresh_metadata(package)
+        queue_refresh(client, package)
+    except (redis.RedisError, OperationalError) as e:
+        current_app.logger.warning(f"Metadata refresh unavailable: {e}")
+
+    if entry is None:
+        skip_cache()
+        return None
+    return entry["metadata"]
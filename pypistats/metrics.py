@@ -0,0 +1,207 @@
+"""Prometheus metrics of the web workers and Celery tasks.
+
+The processes of a service share their metrics through the directory in the
+``PROMETHEUS_MULTIPROC_DIR`` environment variable, which must be set before
+they start. The web and Celery services need a directory each, emptied when
+the service starts, as ``gunicorn.conf.py`` and ``docker-entrypoint.sh`` do.
+Without it, each process only reports its own metrics.
+
+The web workers serve the metrics at ``/metrics``, and the Celery worker on
+``CELERY_METRICS_PORT`` if it is set.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+from celery.signals import task_postrun
+from celery.signals import task_prerun
+from celery.signals import worker_process_shutdown
+from celery.signals import worker_ready
+from flask import g
+from flask import request
+from prometheus_client import REGISTRY
+from prometheus_client import CollectorRegistry
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+from prometheus_client import multiprocess
+from prometheus_client import start_http_server
+from sqlalchemy import event
+
+# Environment variable of the directory shared by the processes of a service
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+# Buckets of the request durations in seconds
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Buckets of the task durations in seconds
+TASK_BUCKETS = (0.1, 1, 10, 30, 60, 300, 600, 1800, 3600, 7200, 14400)
+
+REQUEST_DURATION = Histogram(
+    "pypistats_request_duration_seconds",
+    "Time to serve a request, by endpoint",
+    ["route", "method", "status"],
+    buckets=REQUEST_BUCKETS,
+)
+CACHE_RESPONSES = Counter(
+    "pypistats_cache_responses_total",
+    "Responses of the cached views, by how they were served (hit-local, hit, miss, stale or static)",
+    ["route", "cache"],
+)
+DB_POOL_SIZE = Gauge(
+    "pypistats_db_pool_size",
+    "Connections each pool keeps open, summed over the live workers",
+    ["bind"],
+    multiprocess_mode="livesum",
+)
+DB_CONNECTIONS_OPEN = Gauge(
+    "pypistats_db_connections_open",
+    "Open database connections, summed over the live workers",
+    ["bind"],
+    multiprocess_mode="livesum",
+)
+DB_CONNECTIONS_IN_USE = Gauge(
+    "pypistats_db_connections_in_use",
+    "Database connections checked out of the pools, summed over the live workers",
+    ["bind"],
+    multiprocess_mode="livesum",
+)
+TASK_DURATION = Histogram(
+    "pypistats_task_duration_seconds",
+    "Time to run a Celery task, by its final state",
+    ["task", "state"],
+    buckets=TASK_BUCKETS,
+)
+ETL_STAGE_DURATION = Gauge(
+    "pypistats_etl_stage_duration_seconds",
+    "Duration of each stage of the latest ETL run",
+    ["stage"],
+    multiprocess_mode="mostrecent",
+)
+ETL_ROWS = Counter("pypistats_etl_rows_total", "Rows processed by the ETL stages", ["stage"])
+ETL_ROWS_PER_SECOND = Gauge(
+    "pypistats_etl_rows_per_second",
+    "Rows per second of each stage of the latest ETL run",
+    ["stage"],
+    multiprocess_mode="mostrecent",
+)
+ETL_LAST_SUCCESS = Gauge(
+    "pypistats_etl_last_success_timestamp_seconds",
+    "Time the latest ETL run loaded its downloads",
+    multiprocess_mode="max",
+)
+BACKFILL_DAYS = Counter("pypistats_backfill_days_total", "Days handled by backfills, by result", ["result"])
+BACKFILL_REMAINING = Gauge(
+    "pypistats_backfill_days_remaining",
+    "Days left to handle in each backfill range",
+    ["range"],
+    multiprocess_mode="mostrecent",
+)
+
+# Start times of the running tasks of this process, by task id
+_task_starts = {}
+
+
+def get_registry():
+    """Get the registry of the metrics of all the processes of this service."""
+    if not os.environ.get(MULTIPROC_DIR_ENV):
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def mark_process_dead(pid):
+    """Drop the live gauges of a process that exited."""
+    if os.environ.get(MULTIPROC_DIR_ENV):
+        multiprocess.mark_process_dead(pid)
+
+
+def start_request_timer():
+    """Note the start of the current request."""
+    g.metrics_start = time.perf_counter()
+
+
+def observe_request(response):
+    """Record the duration of the current request and how its cache served it."""
+    start = g.pop("metrics_start", None)
+    if start is None:
+        return response
+    route = request.endpoint or "none"
+    REQUEST_DURATION.labels(route, request.method, response.status_code).observe(time.perf_counter() - start)
+    cache = response.headers.get("X-Cache")
+    if cache is not None:
+        CACHE_RESPONSES.labels(route, cache.lower()).inc()
+    return response
+
+
+def watch_pool(bind, engine):
+    """Track the size and usage of the connection pool of an engine."""
+    pool_size = DB_POOL_SIZE.labels(bind)
+    open_connections = DB_CONNECTIONS_OPEN.labels(bind)
+    in_use = DB_CONNECTIONS_IN_USE.labels(bind)
+
+    def connected(*args):
+        # Set by each worker process when it connects, as the app is created before the workers fork
+        size = getattr(engine.pool, "size", None)
+        if callable(size):
+            pool_size.set(size())
+        open_connections.inc()
+
+    event.listen(engine.pool, "connect", connected)
+    event.listen(engine.pool, "close", lambda *args: open_connections.dec())
+    event.listen(engine.pool, "checkout", lambda *args: in_use.inc())
+    event.listen(engine.pool, "checkin", lambda *args: in_use.dec())
+
+
+def init_metrics(app):
+    """Record the metrics of the requests and database pools of an app."""
+    from pypistats.extensions import db
+
+    app.before_request(start_request_timer)
+    app.after_request(observe_request)
+    with app.app_context():
+        for bind, engine in db.engines.items():
+            watch_pool(bind or "default", engine)
+
+
+def record_etl_stage(stage, elapsed, rows=0):
+    """Record the duration of an ETL stage and the rows per second it processed."""
+    ETL_STAGE_DURATION.labels(stage).set(elapsed)
+    if rows:
+        ETL_ROWS.labels(stage).inc(rows)
+        ETL_ROWS_PER_SECOND.labels(stage).set(rows / elapsed if elapsed else 0)
+
+
+@contextmanager
+def etl_stage(stage):
+    """Record the duration of an ETL stage that completes."""
+    start = time.perf_counter()
+    yield
+    record_etl_stage(stage, time.perf_counter() - start)
+
+
+@task_prerun.connect
+def task_started(task_id=None, **kwargs):
+    _task_starts[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def task_finished(task_id=None, task=None, state=None, **kwargs):
+    start = _task_starts.pop(task_id, None)
+    if start is not None and task is not None:
+        TASK_DURATION.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - start)
+
+
+@worker_ready.connect
+def serve_worker_metrics(sender=None, **kwargs):
+    """Serve the metrics of the Celery worker processes on ``CELERY_METRICS_PORT``."""
+    port = os.environ.get("CELERY_METRICS_PORT")
+    if port:
+        start_http_server(int(port), registry=get_registry())
+
+
+@worker_process_shutdown.connect
+def worker_process_exited(pid=None, **kwargs):
+    mark_process_dead(pid or os.getpid())
@@ -0,0 +1,25 @@
+"""API key tables."""
+
+import datetime
+
+from pypistats.database import Column
+from pypistats.database import Model
+from pypistats.database import SurrogatePK
+from pypistats.extensions import db
+
+
+class ApiKey(SurrogatePK, Model):
+    """An API key granting a higher rate limit tier."""
+
+    __tablename__ = "api_keys"
+
+    name = Column(db.String(128), nullable=False)
+    # sha256 of the key, the key itself is only shown when it is created
+    key_hash = Column(db.String(64), unique=True, nullable=False, index=True)
+    # rate limit tier, see RATELIMIT_TIERS
+    tier = Column(db.String(32), nullable=False)
+    created_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    active = Column(db.Boolean(), nullable=False, default=True)
+
+    def __repr__(self):
+        return "<ApiKey {}>".format(f"{str(self.name)} - {str(self.tier)}")
@@ -80,3 +80,36 @@ class SystemDownloadCount(Model):
 
     def __repr__(self):
         return "<SystemDownloadCount {}".format(f"{str(self.date)} - {str(self.package)} - {str(self.category)}")
+
+
+class TopDownloadCount(Model):
+    """Precomputed rankings of the most downloaded packages."""
+
+    __tablename__ = "top"
+
+    # source table, e.g. overall or python_minor
+    name = Column(db.String(16), primary_key=True, nullable=False)
+    # recency, e.g. day, week, month
+    period = Column(db.String(8), primary_key=True, nullable=False)
+    # category of the source table, e.g. without_mirrors or 3.6
+    category = Column(db.String(16), primary_key=True, nullable=False)
+    rank = Column(db.Integer(), primary_key=True, nullable=False)
+    package = Column(db.String(128), nullable=False)
+    downloads = Column(db.BigInteger(), nullable=False)
+
+    def __repr__(self):
+        return "<TopDownloadCount {}>".format(
+            f"{str(self.name)} - {str(self.period)} - {str(self.category)} - {str(self.rank)}"
+        )
+
+
+class PackageDownloadDate(Model):
+    """The latest date with downloads of each package, kept for the retention window of the download tables."""
+
+    __tablename__ = "packages"
+
+    package = Column(db.String(128), primary_key=True, nullable=False)
+    last_date = Column(db.Date, nullable=False)
+
+    def __repr__(self):
+        return "<PackageDownloadDate {}>".format(f"{str(self.package)} - {str(self.last_date)}")
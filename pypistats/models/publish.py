@@ -0,0 +1,25 @@
+"""ETL publish tables."""
+
+import datetime
+
+from pypistats.database import Column
+from pypistats.database import Model
+from pypistats.database import SurrogatePK
+from pypistats.extensions import db
+
+
+class Publish(SurrogatePK, Model):
+    """A completed ETL run, starting a new generation of the data."""
+
+    __tablename__ = "publish"
+
+    # date of the downloads loaded by the run
+    date = Column(db.Date, nullable=False)
+    published_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # id of the task run that loaded the data
+    run_id = Column(db.String(64))
+    # serialized bloom filter of the packages with data, loaded only when needed
+    packages = db.deferred(Column(db.LargeBinary))
+
+    def __repr__(self):
+        return "<Publish {}>".format(f"{str(self.id)} - {str(self.date)}")
@@ -0,0 +1,22 @@
+"""Database statistics snapshot tables."""
+
+import datetime
+
+from pypistats.database import Column
+from pypistats.database import Model
+from pypistats.database import SurrogatePK
+from pypistats.extensions import db
+
+
+class DbStatsSnapshot(SurrogatePK, Model):
+    """The query, table and index statistics of the database at a point in time."""
+
+    __tablename__ = "db_stats_snapshots"
+
+    label = Column(db.String(128), nullable=False, default="")
+    created_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # statistics of each database server by name, as collected by pypistats.dbstats.collect_stats
+    data = Column(db.JSON, nullable=False)
+
+    def __repr__(self):
+        return "<DbStatsSnapshot {}>".format(f"{str(self.created_at)} - {str(self.label)}")
@@ -0,0 +1,20 @@
+"""Package name normalization."""
+
+import re
+
+# Runs of separators that PEP 503 treats as equivalent
+SEPARATORS = re.compile(r"[-_.]+")
+
+# Package name of the downloads across all packages
+ALL_PACKAGES = "__all__"
+
+
+def canonicalize_name(name):
+    """Get the PEP 503 normalized name of a package.
+
+    Every spelling of a package maps to the same name, e.g. ``Foo.Bar`` and
+    ``foo_bar`` both map to ``foo-bar``. The ``__all__`` aggregate is kept.
+    """
+    if name == ALL_PACKAGES:
+        return name
+    return SEPARATORS.sub("-", name).lower()
@@ -0,0 +1,161 @@
+"""Pre-rendered package pages, generated after each ETL run.
+
+Pages are written as ``<PRERENDER_DIR>/<generation>/packages/<package>.html``
+with a gzip compressed copy next to them. Each generation is rendered into a
+temporary directory that is renamed into place once complete, and the
+``current`` symlink is then switched to it for front proxies.
+
+Usage: python -m pypistats.prerender [--limit N] [--processes N]
+"""
+
+import argparse
+import gzip
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+from flask import g
+from flask import request
+from flask import send_file
+from flask import session
+
+from pypistats.generation import get_generation
+from pypistats.names import canonicalize_name
+
+# Packages rendered by each task of the process pool
+CHUNK_SIZE = 100
+
+# Generation directories kept besides the current one
+KEEP_GENERATIONS = 1
+
+# App of a rendering process
+_worker = {"app": None, "root": None}
+
+
+def get_page_path(root, generation, package):
+    """Get the path of the pre-rendered page of a package."""
+    return os.path.join(root, str(generation), "packages", f"{package}.html")
+
+
+def serve_prerendered():
+    """Serve an anonymous request for a package page from its pre-rendered file if it exists."""
+    root = current_app.config["PRERENDER_DIR"]
+    if not root or request.endpoint != "general.package_page" or request.method not in ("GET", "HEAD"):
+        return None
+    if request.args or session.get("user_id") is not None or "_flashes" in session or "profiler" in g:
+        return None
+    package = canonicalize_name(request.view_args["package"])
+    path = get_page_path(root, get_generation().id, package)
+    gzipped = path + ".gz"
+    if "gzip" in request.accept_encodings and os.path.exists(gzipped):
+        response = send_file(gzipped, mimetype="text/html", conditional=False, etag=False, max_age=None)
+        response.content_encoding = "gzip"
+    elif os.path.exists(path):
+        response = send_file(path, mimetype="text/html", conditional=False, etag=False, max_age=None)
+    else:
+        return None
+    response.vary.add("Accept-Encoding")
+    response.headers["X-Cache"] = "STATIC"
+    return response
+
+
+def init_worker(root):
+    """Set up a rendering process."""
+    from pypistats.extensions import db
+    from pypistats.run import app
+
+    # Connections inherited from the parent process must not be reused
+    with app.app_context():
+        db.engine.dispose(close=False)
+    _worker["app"] = app
+    _worker["root"] = root
+
+
+def render_pages(packages):
+    """Render the pages of packages in a worker process, returning the number written."""
+    app = _worker["app"]
+    view = app.view_functions["general.package_page"].__wrapped__
+    written = 0
+    for package in packages:
+        try:
+            with app.test_request_context(f"/packages/{package}"):
+                g.user = None
+                response = app.make_response(view(package=package))
+                skipped = g.get("skip_cache")
+        except Exception as e:
+            print(f"Error rendering {package}: {e}")
+            continue
+        if response.status_code != 200 or skipped:
+            continue
+        body = response.get_data()
+        path = os.path.join(_worker["root"], "packages", f"{package}.html")
+        with open(path, "wb") as f:
+            f.write(body)
+        with open(path + ".gz", "wb") as f:
+            f.write(gzip.compress(body, compresslevel=9, mtime=0))
+        written += 1
+    return written
+
+
+def prerender(limit=None, processes=None):
+    """Render the package pages of the latest generation into a new versioned directory."""
+    from pypistats.run import app
+    from pypistats.tasks.warm import get_top_packages
+
+    start = time.time()
+    root = app.config["PRERENDER_DIR"]
+    if not root:
+        print("PRERENDER_DIR is not set")
+        return None
+    if limit is None:
+        limit = app.config["PRERENDER_PACKAGES"]
+
+    with app.app_context():
+        generation = get_generation(refresh=True).id
+        packages = get_top_packages(limit or None)
+
+    final = os.path.join(root, str(generation))
+    if os.path.exists(final):
+        print(f"Generation {generation} is already rendered")
+        return None
+
+    os.makedirs(root, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=f".{generation}-", dir=root)
+    os.mkdir(os.path.join(tmp, "packages"))
+    chunks = [packages[i : i + CHUNK_SIZE] for i in range(0, len(packages), CHUNK_SIZE)]
+    try:
+        with ProcessPoolExecutor(processes, initializer=init_worker, initargs=(tmp,)) as pool:
+            written = sum(pool.map(render_pages, chunks))
+        os.chmod(tmp, 0o755)
+        os.rename(tmp, final)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    # Point the current symlink at the new generation atomically
+    link = os.path.join(root, f".current-{generation}")
+    os.symlink(str(generation), link)
+    os.replace(link, os.path.join(root, "current"))
+
+    versions = sorted((int(name) for name in os.listdir(root) if name.isdigit()), reverse=True)
+    for version in versions[KEEP_GENERATIONS + 1 :]:
+        shutil.rmtree(os.path.join(root, str(version)), ignore_errors=True)
+
+    elapsed = round(time.time() - start, 2)
+    print(f"Rendered {written} of {len(packages)} package pages for generation {generation} in {elapsed} seconds")
+    return {"generation": generation, "packages": len(packages), "written": written, "elapsed": elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-render package pages of the latest ETL run")
+    parser.add_argument("--limit", type=int, help="Number of most downloaded packages to render, 0 for all")
+    parser.add_argument("--processes", type=int, help="Number of rendering processes (defaults to the CPU count)")
+    args = parser.parse_args()
+    prerender(args.limit, args.processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""On-demand profiling of single requests and of the stages of ETL and backfill tasks.
+
+A request with ``?profile=cprofile`` (or ``?profile=1``), ``?profile=sample``
+or the same value in an ``X-Profile`` header, sent with the admin
+credentials, is computed without the caches and answered with its profile
+instead of its response:
+
+- ``cprofile`` runs the request under the deterministic profiler and returns
+  the functions with the most cumulative time.
+- ``sample`` samples the stack of the request every few milliseconds and
+  returns the stacks in the folded format of flamegraph.pl and speedscope.
+  It needs thread workers: under gevent the sampler can not interrupt the
+  request, so use ``cprofile`` there.
+
+Profiles are also written to ``PROFILE_DIR`` if it is set, as a ``.prof``
+file for snakeviz or ``python -m pstats``, or a ``.folded`` file.
+
+Tasks run with ``profile=True`` write a profile of each stage to
+``PROFILE_DIR``, or to the temporary directory if it is not set.
+"""
+
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import abort
+from flask import current_app
+from flask import g
+from flask import request
+
+from pypistats.extensions import auth
+
+# Query argument and header asking for a profile
+PROFILE_ARG = "profile"
+PROFILE_HEADER = "X-Profile"
+
+# Profilers by the value of the query argument or header
+MODES = {"1": "cprofile", "cprofile": "cprofile", "sample": "sample"}
+
+# Functions listed in a text profile
+STATS_LIMIT = 50
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.002
+
+
+class StackSampler:
+    """Sampling profiler counting the stacks of one thread, taken from a background thread."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.running = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.running.set()
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        self.thread.join()
+
+    def run(self):
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[get_stack(frame)] += 1
+            time.sleep(self.interval)
+
+    def folded(self):
+        """Get the stacks in the folded format, one ``frame;frame;... count`` line per stack."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def get_stack(frame):
+    """Get the folded stack of a frame, outermost call first."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def format_stats(profile, limit=STATS_LIMIT):
+    """Format the functions of a profile with the most cumulative time."""
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+def get_profile_path(directory, name, extension):
+    """Get a path for a profile in a directory, creating the directory."""
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    return os.path.join(directory, f"{stamp}-{name}.{extension}")
+
+
+def get_profile_mode():
+    """Get the profiler asked for by the current request, or None."""
+    value = request.args.get(PROFILE_ARG) or request.headers.get(PROFILE_HEADER)
+    if value is None:
+        return None
+    if value not in MODES:
+        abort(400)
+    return MODES[value]
+
+
+def start_profile():
+    """Start profiling the current request if an admin asked for it."""
+    mode = get_profile_mode()
+    if mode is None:
+        return
+    if not auth.authenticate(auth.get_auth(), None):
+        abort(401)
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        profiler = StackSampler(threading.get_ident())
+        profiler.start()
+    g.profiler = profiler
+
+
+def finish_profile(response):
+    """Answer a profiled request with its profile, saving it to ``PROFILE_DIR`` if it is set."""
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return response
+    directory = current_app.config["PROFILE_DIR"]
+    name = request.endpoint or "none"
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        body = format_stats(profiler)
+        path = get_profile_path(directory, name, "prof") if directory else None
+        if path:
+            profiler.dump_stats(path)
+    else:
+        profiler.stop()
+        body = profiler.folded()
+        path = get_profile_path(directory, name, "folded") if directory else None
+        if path:
+            with open(path, "w") as f:
+                f.write(body)
+    profiled = current_app.response_class(body, mimetype="text/plain")
+    profiled.headers["X-Profiled-Status"] = str(response.status_code)
+    if path:
+        profiled.headers["X-Profile-File"] = path
+    return profiled
+
+
+def stop_profile(exc):
+    """Stop the profiler of a request that failed before its profile was returned."""
+    profiler = g.pop("profiler", None)
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+    elif profiler is not None:
+        profiler.stop()
+
+
+def init_profiling(app):
+    """Let admins profile single requests of an app.
+
+    Register this after the other app request hooks, so the profile replaces
+    the response before they handle it.
+    """
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.teardown_request(stop_profile)
+
+
+@contextmanager
+def profile_stage(run, stage, enabled=True):
+    """Profile a stage of a task into ``PROFILE_DIR``, as a ``.prof`` file and a text summary."""
+    if not enabled:
+        yield
+        return
+    from pypistats.config import Config
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        directory = os.path.join(Config.PROFILE_DIR or os.path.join(tempfile.gettempdir(), "pypistats-profiles"), run)
+        path = get_profile_path(directory, stage, "prof")
+        profiler.dump_stats(path)
+        with open(path[: -len(".prof")] + ".txt", "w") as f:
+            f.write(format_stats(profiler))
+        print(f"Wrote profile of {stage} to {path}")
@@ -0,0 +1,131 @@
+"""Rate limit keys, tiers and request costs."""
+
+import hashlib
+import secrets
+import time
+
+import click
+from flask import abort
+from flask import current_app
+from flask import g
+from flask import request
+from flask.cli import AppGroup
+from flask_limiter.util import get_remote_address
+
+from pypistats.models.api_key import ApiKey
+from pypistats.names import ALL_PACKAGES
+
+# Request header carrying an API key
+API_KEY_HEADER = "X-API-Key"
+
+# Seconds an API key lookup is reused by a worker, unknown keys included
+API_KEY_CACHE_TTL = 60
+
+# Maximum number of API key lookups remembered by a worker
+MAX_CACHED_KEYS = 10000
+
+# Cost of a request to each endpoint against the rate limits, 1 if not listed
+COSTS = {
+    "api.api_downloads_overall": 2,
+    "api.api_downloads_python_major": 2,
+    "api.api_downloads_python_minor": 2,
+    "api.api_downloads_system": 2,
+    "api.api_bulk_recent": 3,
+    "api.api_bulk_overall": 5,
+}
+
+# Cost of a time series of all packages
+ALL_PACKAGES_COST = 5
+
+# API key lookups by hash: (id, tier, expiry)
+_api_keys = {}
+
+
+def hash_key(key):
+    """Get the hash an API key is stored as."""
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def get_api_key():
+    """Get the id and tier of the API key of the current request, or None without one.
+
+    Requests with an unknown or revoked key are rejected.
+    """
+    if "api_key" in g:
+        return g.api_key
+    key = request.headers.get(API_KEY_HEADER)
+    if not key:
+        g.api_key = None
+        return None
+    key_hash = hash_key(key)
+    cached = _api_keys.get(key_hash)
+    if cached is None or cached[2] < time.monotonic():
+        api_key = ApiKey.query.filter_by(key_hash=key_hash, active=True).first()
+        expiry = time.monotonic() + API_KEY_CACHE_TTL
+        cached = (api_key.id, api_key.tier, expiry) if api_key else (None, None, expiry)
+        # Bound the memory used by requests with made up keys
+        if len(_api_keys) >= MAX_CACHED_KEYS:
+            _api_keys.clear()
+        _api_keys[key_hash] = cached
+    if cached[0] is None:
+        abort(401, "Invalid API key")
+    g.api_key = cached[:2]
+    return g.api_key
+
+
+def get_rate_limit_key():
+    """Get the key requests are counted under: the API key if one is given, else the client address."""
+    api_key = get_api_key()
+    if api_key is not None:
+        return f"key:{api_key[0]}"
+    return get_remote_address()
+
+
+def get_rate_limit():
+    """Get the rate limits of the tier of the current request."""
+    api_key = get_api_key()
+    tiers = current_app.config["RATELIMIT_TIERS"]
+    if api_key is not None and api_key[1] in tiers:
+        return tiers[api_key[1]]
+    return tiers["default"]
+
+
+def get_request_cost():
+    """Get the cost of the current request against the rate limits."""
+    if (request.view_args or {}).get("package") == ALL_PACKAGES and request.endpoint in COSTS:
+        return ALL_PACKAGES_COST
+    return COSTS.get(request.endpoint, 1)
+
+
+api_keys_cli = AppGroup("api-keys", help="Manage API keys.")
+
+
+@api_keys_cli.command("create")
+@click.argument("name")
+@click.option("--tier", default="standard", help="Rate limit tier of the key.")
+def create_api_key(name, tier):
+    """Create an API key and print it."""
+    if tier not in current_app.config["RATELIMIT_TIERS"]:
+        raise click.BadParameter(f"unknown tier {tier}", param_hint="--tier")
+    key = secrets.token_urlsafe(32)
+    api_key = ApiKey.create(name=name, key_hash=hash_key(key), tier=tier)
+    click.echo(f"Created API key {api_key.id} for {name} ({tier}): {key}")
+
+
+@api_keys_cli.command("revoke")
+@click.argument("key_id", type=int)
+def revoke_api_key(key_id):
+    """Revoke an API key."""
+    api_key = ApiKey.get_by_id(key_id)
+    if api_key is None:
+        raise click.BadParameter(f"no API key {key_id}", param_hint="KEY_ID")
+    api_key.update(active=False)
+    click.echo(f"Revoked API key {key_id}")
+
+
+@api_keys_cli.command("list")
+def list_api_keys():
+    """List the API keys."""
+    for api_key in ApiKey.query.order_by(ApiKey.id):
+        status = "active" if api_key.active else "revoked"
+        click.echo(f"{api_key.id}\t{api_key.name}\t{api_key.tier}\t{status}\t{api_key.created_at:%Y-%m-%d}")
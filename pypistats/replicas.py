@@ -0,0 +1,106 @@
+"""Routing of read-only queries to PostgreSQL read replicas."""
+
+import random
+import time
+
+import sqlalchemy as sa
+from flask import current_app
+from flask import g
+from flask import has_request_context
+from flask_sqlalchemy.session import Session
+
+# Tables always read from the primary: the published generation and the user data
+PRIMARY_TABLES = ("publish", "users")
+
+# Prefix of the bind keys of the replicas
+REPLICA_BIND_PREFIX = "replica"
+
+# Replication lag of a replica in seconds, zero when it has replayed all it received
+LAG_QUERY = sa.text(
+    "SELECT coalesce(CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END, 0)"
+)
+
+# Latest generation of the data on a replica
+PUBLISHED_QUERY = sa.text("SELECT coalesce(max(id), 0) FROM publish")
+
+# The replicas that are up to date and when they were last checked
+_replicas = {"healthy": [], "checked": None}
+
+
+def get_replica_binds(replica_urls):
+    """Get the SQLAlchemy binds of comma separated replica urls."""
+    urls = [url.strip() for url in replica_urls.split(",") if url.strip()]
+    return {f"{REPLICA_BIND_PREFIX}{i}": url for i, url in enumerate(urls)}
+
+
+def use_replica():
+    """Let the read-only queries of the current request go to a replica."""
+    g.use_replica = True
+
+
+def check_replica(engine, generation):
+    """Check that a replica has the published generation of the data and is not lagging behind."""
+    try:
+        with engine.connect() as connection:
+            published = connection.execute(PUBLISHED_QUERY).scalar()
+            lag = connection.execute(LAG_QUERY).scalar()
+    except sa.exc.SQLAlchemyError as e:
+        current_app.logger.warning(f"Replica {engine.url.host} unavailable: {e}")
+        return False
+    return published >= generation and lag <= current_app.config["REPLICA_MAX_LAG"]
+
+
+def get_healthy_replicas(engines):
+    """Get the replicas that can serve reads, checked at most once every ``REPLICA_CHECK_INTERVAL`` seconds."""
+    from pypistats.generation import get_generation
+
+    now = time.monotonic()
+    checked = _replicas["checked"]
+    if checked is None or now - checked >= current_app.config["REPLICA_CHECK_INTERVAL"]:
+        _replicas["checked"] = now
+        generation = get_generation().id
+        _replicas["healthy"] = [engine for engine in engines if check_replica(engine, generation)]
+    return _replicas["healthy"]
+
+
+class RoutingSession(Session):
+    """Session sending the read-only queries of requests marked by ``use_replica`` to a replica.
+
+    Everything else goes to the primary: writes, queries of a session with
+    pending changes or with changes flushed in its current transaction,
+    queries outside of such requests, and the tables in ``PRIMARY_TABLES``.
+    When no replica is up to date, reads fall back to the primary too.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and mapper is not None and self._is_replica_read(mapper, clause):
+            engines = [e for key, e in self._db.engines.items() if key and key.startswith(REPLICA_BIND_PREFIX)]
+            healthy = get_healthy_replicas(engines) if engines else []
+            if healthy:
+                return random.choice(healthy)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _is_replica_read(self, mapper, clause):
+        """Check whether a query may be read from a replica."""
+        if not has_request_context() or not g.get("use_replica"):
+            return False
+        if self._flushing or self.new or self.dirty or self.deleted or self.info.get("flushed"):
+            return False
+        if clause is not None and not getattr(clause, "is_select", False):
+            return False
+        table = getattr(sa.inspect(mapper, raiseerr=False), "local_table", None)
+        return table is not None and table.name not in PRIMARY_TABLES
+
+
+@sa.event.listens_for(RoutingSession, "after_flush")
+def mark_flushed(session, flush_context):
+    """Keep the reads of a transaction that wrote on the primary, which alone has its uncommitted changes."""
+    session.info["flushed"] = True
+
+
+@sa.event.listens_for(RoutingSession, "after_transaction_end")
+def clear_flushed(session, transaction):
+    """Let the reads go to the replicas again once the transaction that wrote ends."""
+    if transaction.parent is None:
+        session.info.pop("flushed", None)
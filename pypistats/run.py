@@ -7,21 +7,23 @@ from flask import redirect
 from flask import request
 from flask import session
 from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from pypistats.application import create_app
 from pypistats.config import configs
 from pypistats.models.user import User
+from pypistats.ratelimit import get_rate_limit
+from pypistats.ratelimit import get_rate_limit_key
+from pypistats.ratelimit import get_request_cost
 
 # change this for migrations
 env = os.environ.get("ENV", "development")
 
 app = create_app(configs[env])
 
-# Rate limiting per IP/worker
+# Rate limiting per IP or API key, shared by the workers
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=2)
-limiter = Limiter(get_remote_address, app=app, default_limits=["5 per second", "30 per minute"])
+limiter = Limiter(get_rate_limit_key, app=app, default_limits=[get_rate_limit], default_limits_cost=get_request_cost)
 
 app.logger.info(f"Environment: {env}")
 
@@ -0,0 +1,115 @@
+"""In-memory package name lookups."""
+
+from array import array
+from bisect import bisect_left
+from heapq import nlargest
+
+from pypistats.bloom import BloomFilter
+from pypistats.extensions import db
+from pypistats.generation import get_generation
+from pypistats.models.download import RecentDownloadCount
+from pypistats.models.publish import Publish
+
+# Maximum number of memoized autocomplete results
+MAX_COMPLETIONS = 10000
+
+# Maximum number of packages confirmed missing remembered per generation
+MAX_MISSING = 100000
+
+# The index of this worker and the generation it was loaded from
+_index = {"index": None, "generation": None}
+
+# The package filter of this worker, the generation it was loaded from and confirmed misses
+_filter = {"filter": None, "generation": None, "missing": set()}
+
+
+class PackageIndex:
+    """Sorted package names with their monthly downloads.
+
+    Prefix lookups bisect the sorted names, so they cost the same regardless
+    of how many packages exist and never touch the database.
+    """
+
+    def __init__(self, rows):
+        """Create instance from (package, downloads) rows."""
+        rows = sorted(rows)
+        self.packages = [package for package, _ in rows]
+        self.downloads = array("q", (downloads for _, downloads in rows))
+        self._completions = {}
+
+    def __len__(self):
+        return len(self.packages)
+
+    def __contains__(self, package):
+        idx = bisect_left(self.packages, package)
+        return idx < len(self.packages) and self.packages[idx] == package
+
+    def _range(self, prefix):
+        """Get the index range of the packages starting with prefix."""
+        start = bisect_left(self.packages, prefix)
+        if not prefix:
+            return start, len(self.packages)
+        end = bisect_left(self.packages, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        return start, end
+
+    def search(self, prefix, limit=20):
+        """Get the packages starting with prefix in alphabetical order."""
+        start, end = self._range(prefix)
+        return self.packages[start : min(end, start + limit)]
+
+    def complete(self, prefix, limit=10):
+        """Get the most downloaded packages starting with prefix."""
+        key = (prefix, limit)
+        if key not in self._completions:
+            if len(self._completions) >= MAX_COMPLETIONS:
+                self._completions.clear()
+            start, end = self._range(prefix)
+            top = nlargest(limit, range(start, end), key=self.downloads.__getitem__)
+            self._completions[key] = [(self.packages[idx], self.downloads[idx]) for idx in top]
+        return self._completions[key]
+
+
+def get_package_index_query():
+    """Get the query of the packages and their downloads in the past month."""
+    return db.session.query(RecentDownloadCount.package, RecentDownloadCount.downloads).filter_by(category="month")
+
+
+def get_package_index():
+    """Get the package index of this worker, loading it again after each publish."""
+    generation = get_generation()
+    if _index["index"] is None or _index["generation"] != generation:
+        _index["index"] = PackageIndex((package, downloads) for package, downloads in get_package_index_query())
+        _index["generation"] = generation
+    return _index["index"]
+
+
+def get_package_filter():
+    """Get the bloom filter of the packages with data, loading it again after each publish."""
+    generation = get_generation()
+    if _filter["generation"] != generation:
+        packages = db.session.query(Publish.packages).filter_by(id=generation.id).scalar()
+        _filter["filter"] = BloomFilter.from_bytes(packages) if packages else None
+        _filter["missing"] = set()
+        _filter["generation"] = generation
+    return _filter["filter"]
+
+
+def is_known_package(package):
+    """Check whether a package may have download data, without querying the database.
+
+    Packages missing from the filter built by the latest publish, or confirmed
+    missing since, are unknown. Every package is known until a filter exists.
+    """
+    if package == "__all__":
+        return True
+    bloom = get_package_filter()
+    if package in _filter["missing"]:
+        return False
+    return bloom is None or package in bloom
+
+
+def record_missing_package(package):
+    """Remember a package confirmed to have no download data until the next publish."""
+    if len(_filter["missing"]) >= MAX_MISSING:
+        _filter["missing"].clear()
+    _filter["missing"].add(package)
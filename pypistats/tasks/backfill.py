@@ -9,6 +9,8 @@ from typing import Tuple
 from celery import group
 
 from pypistats.extensions import celery
+from pypistats.metrics import BACKFILL_DAYS
+from pypistats.metrics import BACKFILL_REMAINING
 from pypistats.tasks.pypi import etl
 
 
@@ -82,6 +84,8 @@ def backfill_sequential(
     delay_seconds: int = 2,
     skip_existing: bool = False,
     update_recent: bool = True,
+    profile: bool = False,
+    publish: bool = True,
 ):
     """
     Backfill data sequentially, one day at a time.
@@ -93,11 +97,15 @@ def backfill_sequential(
         delay_seconds: Delay between days to avoid overwhelming BigQuery
         skip_existing: Skip days that already have data
         update_recent: Update recent stats after backfill completes
+        profile: Write a profile of each ETL stage of each day to PROFILE_DIR
+        publish: Publish a single new generation of the data once the backfill completes
 
     Returns:
         Dict with results for each day
     """
+    from pypistats.tasks.pypi import record_publish
     from pypistats.tasks.pypi import update_recent_stats
+    from pypistats.tasks.pypi import update_top_stats
 
     start = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
     end = datetime.datetime.strptime(end_date, "%Y-%m-%d").date()
@@ -107,9 +115,11 @@ def backfill_sequential(
     total_days = (end - start).days + 1
     processed = 0
     last_successful_date = None
+    remaining = BACKFILL_REMAINING.labels(f"{start_date}..{end_date}")
 
     while current <= end:
         date_str = str(current)
+        remaining.set(total_days - processed)
         processed += 1
 
         # Update task state for monitoring
@@ -136,15 +146,21 @@ def backfill_sequential(
                 if count > 0:
                     print(f"Skipping {date_str} - data already exists ({count} rows)")
                     results[date_str] = {"skipped": True, "existing_rows": count}
+                    BACKFILL_DAYS.labels("skipped").inc()
                     current += datetime.timedelta(days=1)
                     continue
 
             print(f"Processing {date_str} ({processed}/{total_days})")
             # For backfill, we don't want to update recent stats during each ETL
             # as it will use wrong date calculations
-            result = etl(date_str, purge=False, use_sqlite=True, update_recent=False)
+            # Nor publish a generation per day, which would empty the caches each time
+            result = etl(date_str, purge=False, use_sqlite=True, update_recent=False, profile=profile, publish=False)
             results[date_str] = result
-            last_successful_date = date_str
+            if result["loaded"]:
+                last_successful_date = date_str
+                BACKFILL_DAYS.labels("processed").inc()
+            else:
+                BACKFILL_DAYS.labels("failed").inc()
 
             # Add delay between days
             if current < end and delay_seconds > 0:
@@ -154,25 +170,36 @@ def backfill_sequential(
         except Exception as e:
             print(f"Error processing {date_str}: {e}")
             results[date_str] = {"error": str(e)}
+            BACKFILL_DAYS.labels("failed").inc()
 
         current += datetime.timedelta(days=1)
 
+    remaining.set(0)
+
     # Update recent stats based on the last successful date
     if update_recent and last_successful_date:
         print(f"Updating recent stats based on {last_successful_date}...")
         try:
             recent_result = update_recent_stats(last_successful_date)
             results["recent_stats_updated"] = recent_result
+            results["top_stats_updated"] = update_top_stats(last_successful_date)
             print("Recent stats updated successfully")
         except Exception as e:
             print(f"Error updating recent stats: {e}")
             results["recent_stats_error"] = str(e)
 
+    # Published after the recent and top stats are rebuilt, so the new generation includes them
+    if publish and last_successful_date:
+        results["publish"] = record_publish(last_successful_date, self.request.id)
+    results["last_successful_date"] = last_successful_date
+
     return results
 
 
 @celery.task
-def backfill_parallel(start_date: str, end_date: str, max_parallel: int = 3, chunk_days: int = 7):
+def backfill_parallel(
+    start_date: str, end_date: str, max_parallel: int = 3, chunk_days: int = 7, profile: bool = False
+):
     """
     Backfill data in parallel chunks.
     Good for large ranges when you want faster processing.
@@ -182,6 +209,7 @@ def backfill_parallel(start_date: str, end_date: str, max_parallel: int = 3, chu
         end_date: End date in YYYY-MM-DD format
         max_parallel: Maximum parallel ETL tasks
         chunk_days: Days per chunk
+        profile: Write a profile of each ETL stage of each day to PROFILE_DIR
 
     Returns:
         Group result that can be monitored
@@ -193,7 +221,10 @@ def backfill_parallel(start_date: str, end_date: str, max_parallel: int = 3, chu
         print(f"  Chunk {i+1}: {chunk_start} to {chunk_end}")
 
     # Create a group of sequential backfill tasks
-    job = group(backfill_sequential.s(chunk_start, chunk_end, delay_seconds=2) for chunk_start, chunk_end in chunks)
+    job = group(
+        backfill_sequential.s(chunk_start, chunk_end, delay_seconds=2, profile=profile)
+        for chunk_start, chunk_end in chunks
+    )
 
     # Apply with limited concurrency
     return job.apply_async(max_retries=3)
@@ -207,6 +238,7 @@ def backfill_months(
     delay_seconds: int = 2,
     skip_existing: bool = False,
     update_recent: bool = True,
+    profile: bool = False,
 ):
     """
     Backfill complete calendar months.
@@ -217,12 +249,16 @@ def backfill_months(
         delay_seconds: Delay between days
         skip_existing: Skip days with existing data
         update_recent: Update recent stats after backfill completes
+        profile: Write a profile of each ETL stage of each day to PROFILE_DIR
 
     Returns:
         Dict with results organized by month
     """
+    from pypistats.tasks.pypi import record_publish
+
     month_ranges = get_month_ranges(start_month, end_month)
     results = {}
+    last_successful_date = None
 
     for month_idx, (month_start, month_end) in enumerate(month_ranges):
         month_key = month_start[:7]  # YYYY-MM
@@ -246,9 +282,12 @@ def backfill_months(
             delay_seconds=delay_seconds,
             skip_existing=skip_existing,
             update_recent=False,  # Will update at the end of all months
+            profile=profile,
+            publish=False,  # Will publish at the end of all months
         )
 
         results[month_key] = month_results
+        last_successful_date = month_results["last_successful_date"] or last_successful_date
 
     # Update recent stats based on the last date processed
     if update_recent:
@@ -256,14 +295,19 @@ def backfill_months(
         print(f"Updating recent stats based on {last_date}...")
         try:
             from pypistats.tasks.pypi import update_recent_stats
+            from pypistats.tasks.pypi import update_top_stats
 
             recent_result = update_recent_stats(last_date)
             results["recent_stats_updated"] = recent_result
+            results["top_stats_updated"] = update_top_stats(last_date)
             print("Recent stats updated successfully")
         except Exception as e:
             print(f"Error updating recent stats: {e}")
             results["recent_stats_error"] = str(e)
 
+    if last_successful_date:
+        results["publish"] = record_publish(last_successful_date, self.request.id)
+
     return results
 
 
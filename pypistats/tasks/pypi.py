@@ -5,13 +5,24 @@ import os
 import sqlite3
 import tempfile
 import time
+import uuid
 from contextlib import contextmanager
 
 import psycopg2
 from google.cloud import bigquery
 from psycopg2.extras import execute_values
 
+from pypistats.bloom import BloomFilter
 from pypistats.extensions import celery
+from pypistats.metrics import ETL_LAST_SUCCESS
+from pypistats.metrics import etl_stage
+from pypistats.metrics import record_etl_stage
+from pypistats.names import canonicalize_name
+from pypistats.profiling import profile_stage
+from pypistats.tasks.warm import prerender_pages
+from pypistats.tasks.warm import warm_cache
+from pypistats.tracing import span
+from pypistats.tracing import traced
 
 # Mirrors to disregard when considering downloads
 MIRRORS = ("bandersnatch", "z3c.pypimirror", "Artifactory", "devpi")
@@ -25,6 +36,15 @@ PSQL_TABLES = ["overall", "python_major", "python_minor", "system"]
 # Number of days to retain records
 MAX_RECORD_AGE = 180
 
+# Number of packages to rank per table, period and category
+MAX_TOP_RANK = 1000
+
+# Downloads without mirrors of each package in a period, {clause} being one of get_period_clauses
+RECENT_QUERY = """SELECT package, '{period}' as category, sum(downloads) AS downloads
+                FROM overall
+                WHERE category = 'without_mirrors' and {clause}
+                GROUP BY package"""
+
 # Configurable batch size for processing (default 100,000)
 BATCH_SIZE = int(os.environ.get("ETL_BATCH_SIZE", "100000"))
 
@@ -38,6 +58,10 @@ def get_sqlite_db(date):
 
     print(f"Creating temporary SQLite database: {db_path}")
 
+    # Downloads are summed on insert, so never reuse a database left by a failed run
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
 
@@ -100,6 +124,7 @@ def get_google_credentials():
     return credentials, project_id
 
 
+@traced("etl.sqlite_insert")
 def process_batch_to_sqlite(cursor, table, rows):
     """Insert a batch of rows into SQLite table."""
     # Filter invalid rows
@@ -114,6 +139,9 @@ def process_batch_to_sqlite(cursor, table, rows):
             else:
                 processed_row.append(item)
 
+        # Store every spelling of a package under its canonical name
+        processed_row[1] = canonicalize_name(processed_row[1])
+
         # Skip rows with overly long package names
         if any(len(str(item)) > 128 for item in processed_row[1:2]):  # Check package name only
             continue
@@ -141,8 +169,11 @@ def process_batch_to_sqlite(cursor, table, rows):
             chunk = valid_rows[i : i + SQLITE_CHUNK_SIZE]
 
             # Use executemany for better performance
+            # Spellings that canonicalize to the same package are summed
             cursor.executemany(
-                f"INSERT OR REPLACE INTO {table} (date, package, category, downloads) VALUES (?, ?, ?, ?)", chunk
+                f"""INSERT INTO {table} (date, package, category, downloads) VALUES (?, ?, ?, ?)
+                ON CONFLICT (date, package, category) DO UPDATE SET downloads = downloads + excluded.downloads""",
+                chunk,
             )
         return True
     except sqlite3.Error as e:
@@ -150,9 +181,12 @@ def process_batch_to_sqlite(cursor, table, rows):
         return False
 
 
+@traced("etl.postgres_transfer")
 def transfer_sqlite_to_postgres(sqlite_cursor, date):
     """Transfer all data from SQLite to PostgreSQL in a single atomic transaction."""
     pg_conn, pg_cursor = get_connection_cursor()
+    start = time.time()
+    transferred = 0
 
     # Smaller chunk size to reduce memory usage
     # 10k rows is more manageable and still efficient
@@ -210,6 +244,7 @@ def transfer_sqlite_to_postgres(sqlite_cursor, date):
 
                     chunks_transferred += 1
                     offset += TRANSFER_CHUNK_SIZE
+                    transferred += len(chunk)
 
                     # Report progress every 50 chunks (500k rows with 10k chunks)
                     if chunks_transferred % 50 == 0:
@@ -218,6 +253,7 @@ def transfer_sqlite_to_postgres(sqlite_cursor, date):
         # Commit the transaction - all tables update atomically
         pg_conn.commit()
         print("PostgreSQL transaction committed successfully!")
+        record_etl_stage("transfer", time.time() - start, transferred)
 
         return True
 
@@ -231,6 +267,7 @@ def transfer_sqlite_to_postgres(sqlite_cursor, date):
         pg_conn.close()
 
 
+@traced("etl.download")
 def get_daily_download_stats_sqlite(date):
     """Stream BigQuery data into SQLite, then transfer to PostgreSQL atomically."""
     start = time.time()
@@ -246,69 +283,78 @@ def get_daily_download_stats_sqlite(date):
 
         print(f"Date: {date}")
         print("Sending query to BigQuery...")
+        stream_start = time.time()
         query = get_query(date)
         query_job = bq_client.query(query, job_config=job_config)
-        iterator = query_job.result()
+        with span("etl.bigquery_query", date=date):
+            iterator = query_job.result()
         print(f"Streaming to SQLite (batch size: {BATCH_SIZE})")
 
         batch_data = {}
         row_count = 0
         batches_processed = 0
 
-        for row in iterator:
-            row_count += 1
+        with span("etl.bigquery_stream", date=date) as stream_span:
+            for row in iterator:
+                row_count += 1
 
-            category_label = row["category_label"]
-            if category_label not in batch_data:
-                batch_data[category_label] = []
+                category_label = row["category_label"]
+                if category_label not in batch_data:
+                    batch_data[category_label] = []
 
-            batch_data[category_label].append([date, row["package"], row["category"], row["downloads"]])
+                batch_data[category_label].append([date, row["package"], row["category"], row["downloads"]])
 
-            # Process batch when it reaches size limit
-            if len(batch_data[category_label]) >= BATCH_SIZE:
-                batches_processed += 1
-                print(f"Writing batch {batches_processed} to SQLite ({category_label}: {BATCH_SIZE} rows)")
-                process_batch_to_sqlite(sqlite_cursor, category_label, batch_data[category_label])
-                batch_data[category_label] = []
+                # Process batch when it reaches size limit
+                if len(batch_data[category_label]) >= BATCH_SIZE:
+                    batches_processed += 1
+                    print(f"Writing batch {batches_processed} to SQLite ({category_label}: {BATCH_SIZE} rows)")
+                    process_batch_to_sqlite(sqlite_cursor, category_label, batch_data[category_label])
+                    batch_data[category_label] = []
 
-            if row_count % 1000000 == 0:
-                sqlite_conn.commit()  # Less frequent commits for better performance
-                print(f"Processed {row_count} rows into SQLite...")
+                if row_count % 1000000 == 0:
+                    sqlite_conn.commit()  # Less frequent commits for better performance
+                    print(f"Processed {row_count} rows into SQLite...")
 
-        # Process remaining batches
-        for category_label, rows in batch_data.items():
-            if rows:
-                print(f"Writing final batch to SQLite ({category_label}: {len(rows)} rows)")
-                process_batch_to_sqlite(sqlite_cursor, category_label, rows)
+            # Process remaining batches
+            for category_label, rows in batch_data.items():
+                if rows:
+                    print(f"Writing final batch to SQLite ({category_label}: {len(rows)} rows)")
+                    process_batch_to_sqlite(sqlite_cursor, category_label, rows)
+            if stream_span is not None:
+                stream_span.set_attribute("rows", row_count)
 
         sqlite_conn.commit()
         print(f"SQLite staging complete: {row_count} rows in {batches_processed} batches")
-
-        # Create indexes now for faster aggregation
-        print("Creating indexes for aggregation...")
-        for table in PSQL_TABLES:
-            sqlite_cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_date ON {table} (date)")
-            sqlite_cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_package ON {table} (package)")
-        sqlite_conn.commit()
-
-        # Add __all__ aggregations in SQLite
-        print("Computing __all__ aggregations in SQLite...")
-        for table in PSQL_TABLES:
-            sqlite_cursor.execute(
-                f"""
-                INSERT OR REPLACE INTO {table} (date, package, category, downloads)
-                SELECT 
-                    date,
-                    '__all__' AS package,
-                    category,
-                    SUM(downloads) AS downloads
-                FROM {table}
-                WHERE date = ? AND package != '__all__'
-                GROUP BY date, category
-            """,
-                (date,),
-            )
-        sqlite_conn.commit()
+        record_etl_stage("bigquery", time.time() - stream_start, row_count)
+        aggregate_start = time.time()
+
+        with span("etl.sqlite_aggregate", date=date):
+            # Create indexes now for faster aggregation
+            print("Creating indexes for aggregation...")
+            for table in PSQL_TABLES:
+                sqlite_cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_date ON {table} (date)")
+                sqlite_cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_package ON {table} (package)")
+            sqlite_conn.commit()
+
+            # Add __all__ aggregations in SQLite
+            print("Computing __all__ aggregations in SQLite...")
+            for table in PSQL_TABLES:
+                sqlite_cursor.execute(
+                    f"""
+                    INSERT OR REPLACE INTO {table} (date, package, category, downloads)
+                    SELECT 
+                        date,
+                        '__all__' AS package,
+                        category,
+                        SUM(downloads) AS downloads
+                    FROM {table}
+                    WHERE date = ? AND package != '__all__'
+                    GROUP BY date, category
+                """,
+                    (date,),
+                )
+            sqlite_conn.commit()
+        record_etl_stage("aggregate", time.time() - aggregate_start)
 
         # Now transfer everything to PostgreSQL in a single transaction
         print("Starting atomic transfer to PostgreSQL...")
@@ -323,6 +369,7 @@ def get_daily_download_stats_sqlite(date):
         }
 
 
+@traced("etl.download")
 def get_daily_download_stats(date):
     """Get daily download stats for pypi packages from BigQuery."""
     start = time.time()
@@ -385,6 +432,7 @@ def get_daily_download_stats(date):
     connection.close()
     print(f"Total: {row_count} rows from gbq, {batches_processed} batches processed")
     print("Elapsed: " + str(time.time() - start))
+    record_etl_stage("bigquery", time.time() - start, row_count)
     results["elapsed"] = time.time() - start
     results["rows_processed"] = row_count
     results["batches_processed"] = batches_processed
@@ -409,6 +457,9 @@ def update_table(connection, cursor, table, rows, date):
 
     delete_rows = []
     for row_idx, row in enumerate(rows):
+        # Store every spelling of a package under its canonical name
+        if row[1] is not None:
+            row[1] = canonicalize_name(row[1])
         for idx, item in enumerate(row):
             if item is None:
                 row[idx] = "null"
@@ -430,6 +481,16 @@ def update_table(connection, cursor, table, rows, date):
     for idx in sorted(delete_rows, reverse=True):
         rows.pop(idx)
 
+    # Sum the spellings that canonicalize to the same package
+    merged = {}
+    for row in rows:
+        key = tuple(row[:3])
+        if key in merged:
+            merged[key][3] += row[3]
+        else:
+            merged[key] = row
+    rows = list(merged.values())
+
     # Only delete if date is provided (for backward compatibility)
     if date:
         delete_query = f"""DELETE FROM {table}
@@ -438,7 +499,8 @@ def update_table(connection, cursor, table, rows, date):
         cursor.execute(delete_query)
 
     insert_query = f"""INSERT INTO {table} (date, package, category, downloads)
-            VALUES %s"""
+            VALUES %s
+            ON CONFLICT (date, package, category) DO UPDATE SET downloads = {table}.downloads + EXCLUDED.downloads"""
 
     try:
         print(insert_query)
@@ -450,6 +512,7 @@ def update_table(connection, cursor, table, rows, date):
         return False
 
 
+@traced("etl.all_packages")
 def update_all_package_stats(date=None):
     """Update stats for __all__ packages."""
     print("__all__")
@@ -493,6 +556,19 @@ def update_all_package_stats(date=None):
     return success
 
 
+def get_period_clauses(date):
+    """Get the conditions on the date of the day, week and month periods ending on a date (YYYY-MM-DD)."""
+    date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+    date_week = date - datetime.timedelta(days=7)
+    date_month = date - datetime.timedelta(days=30)
+    return {
+        "day": f"date = '{str(date)}'",
+        "week": f"date > '{str(date_week)}'",
+        "month": f"date > '{str(date_month)}'",
+    }
+
+
+@traced("etl.recent")
 def update_recent_stats(date=None):
     """Update daily, weekly, monthly stats for all packages."""
     print("recent")
@@ -503,25 +579,11 @@ def update_recent_stats(date=None):
 
     connection, cursor = get_connection_cursor()
 
-    downloads_table = "overall"
     recent_table = "recent"
 
-    date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
-    date_week = date - datetime.timedelta(days=7)
-    date_month = date - datetime.timedelta(days=30)
-
-    where = {
-        "day": f"date = '{str(date)}'",
-        "week": f"date > '{str(date_week)}'",
-        "month": f"date > '{str(date_month)}'",
-    }
-
     success = {}
-    for period, clause in where.items():
-        select_query = f"""SELECT package, '{period}' as category, sum(downloads) AS downloads
-                FROM {downloads_table}
-                WHERE category = 'without_mirrors' and {clause}
-                GROUP BY package"""
+    for period, clause in get_period_clauses(date).items():
+        select_query = RECENT_QUERY.format(period=period, clause=clause)
         cursor.execute(select_query)
         values = cursor.fetchall()
 
@@ -545,6 +607,110 @@ def update_recent_stats(date=None):
     return success
 
 
+@traced("etl.top")
+def update_top_stats(date=None):
+    """Update the daily, weekly, monthly package rankings for each table and category."""
+    print("top")
+    start = time.time()
+
+    if date is None:
+        date = str(datetime.date.today() - datetime.timedelta(days=1))
+
+    connection, cursor = get_connection_cursor()
+
+    top_table = "top"
+
+    success = {}
+    for table in PSQL_TABLES:
+        for period, clause in get_period_clauses(date).items():
+            delete_query = f"""DELETE FROM {top_table}
+                    WHERE name = '{table}' and period = '{period}'"""
+            insert_query = f"""INSERT INTO {top_table} (name, period, category, rank, package, downloads)
+                    SELECT '{table}', '{period}', category, rank, package, downloads
+                    FROM (
+                        SELECT category, package, downloads,
+                            ROW_NUMBER() OVER (PARTITION BY category ORDER BY downloads DESC, package) AS rank
+                        FROM (
+                            SELECT coalesce(category, 'null') AS category, package, sum(downloads) AS downloads
+                            FROM {table}
+                            WHERE package != '__all__' and {clause}
+                            GROUP BY 1, 2
+                        ) AS totals
+                    ) AS ranked
+                    WHERE rank <= {MAX_TOP_RANK}"""
+            try:
+                print(delete_query)
+                cursor.execute(delete_query)
+                print(insert_query)
+                cursor.execute(insert_query)
+                connection.commit()
+                success[f"{table}_{period}"] = True
+            except psycopg2.Error as e:
+                print(f"Error updating top {table} for {period}: {e}")
+                connection.rollback()
+                success[f"{table}_{period}"] = False
+
+    connection.close()
+    print("Elapsed: " + str(time.time() - start))
+    success["elapsed"] = time.time() - start
+    return success
+
+
+@traced("etl.packages")
+def update_package_dates(date):
+    """Record the packages with downloads on a date (YYYY-MM-DD) in the packages table."""
+    print("packages")
+    connection, cursor = get_connection_cursor()
+    cursor.execute(
+        """INSERT INTO packages (package, last_date)
+            SELECT DISTINCT package, date FROM overall WHERE date = %s AND package != '__all__'
+            ON CONFLICT (package) DO UPDATE SET last_date = greatest(packages.last_date, EXCLUDED.last_date)""",
+        (date,),
+    )
+    updated = cursor.rowcount
+    connection.commit()
+    connection.close()
+    print(f"Updated the last date of {updated} packages")
+    return updated
+
+
+def build_package_filter():
+    """Build a bloom filter of the packages with downloads in the retention window.
+
+    The packages come from the packages table, which the ETL keeps up to
+    date with each loaded day and purges with the download tables, rather
+    than from a scan of overall.
+    """
+    connection, cursor = get_connection_cursor()
+    cursor.execute("SELECT package FROM packages")
+    packages = [row[0] for row in cursor.fetchall()]
+    connection.close()
+
+    bloom = BloomFilter(len(packages))
+    for package in packages:
+        bloom.add(package)
+    print(f"Built package filter of {len(packages)} packages")
+    return bloom.to_bytes()
+
+
+@traced("etl.publish")
+def record_publish(date, run_id=None):
+    """Record a completed run, starting a new generation of the data for the web workers."""
+    if run_id is None:
+        run_id = uuid.uuid4().hex
+    packages = build_package_filter()
+    connection, cursor = get_connection_cursor()
+    cursor.execute(
+        "INSERT INTO publish (date, published_at, run_id, packages) VALUES (%s, now() at time zone 'utc', %s, %s) RETURNING id",
+        (date, run_id, psycopg2.Binary(packages)),
+    )
+    publish_id = cursor.fetchone()[0]
+    connection.commit()
+    connection.close()
+    print(f"Published generation {publish_id} for {date}")
+    return publish_id
+
+
 def get_connection_cursor():
     """Get a db connection cursor."""
     connection = psycopg2.connect(os.environ["DATABASE_URL"])
@@ -552,6 +718,7 @@ def get_connection_cursor():
     return connection, cursor
 
 
+@traced("etl.purge")
 def purge_old_data(date=None):
     """Purge old data records."""
     print("Purge")
@@ -579,11 +746,23 @@ def purge_old_data(date=None):
             connection.rollback()
             success[table] = False
 
+    delete_query = f"""DELETE FROM packages where last_date < '{purge_date}'"""
+    try:
+        print(delete_query)
+        cursor.execute(delete_query)
+        connection.commit()
+        success["packages"] = True
+    except psycopg2.Error as e:
+        print(f"Error purging packages: {e}")
+        connection.rollback()
+        success["packages"] = False
+
     print("Elapsed: " + str(time.time() - start))
     success["elapsed"] = time.time() - start
     return success
 
 
+@traced("etl.vacuum")
 def vacuum_analyze():
     """Vacuum and analyze the db."""
     connection, cursor = get_connection_cursor()
@@ -690,8 +869,17 @@ def get_query(date):
     """
 
 
+def is_loaded(downloads):
+    """Check whether the download stage loaded the rows of its date into every download table."""
+    if not downloads.get("rows_processed"):
+        return False
+    if "success" in downloads:
+        return bool(downloads["success"])
+    return all(downloads.get(table, True) for table in PSQL_TABLES)
+
+
 @celery.task
-def etl(date=None, purge=True, use_sqlite=True, update_recent=True):
+def etl(date=None, purge=True, use_sqlite=True, update_recent=True, profile=False, publish=True):
     """
     Perform the stats download.
 
@@ -700,30 +888,62 @@ def etl(date=None, purge=True, use_sqlite=True, update_recent=True):
         purge: Whether to purge old data
         use_sqlite: Use SQLite staging for atomic updates (recommended)
         update_recent: Whether to update recent stats table (set False for backfill)
+        profile: Whether to write a profile of each stage to PROFILE_DIR
+        publish: Whether to publish a new generation of the data once it is loaded (set False for backfill)
     """
     if date is None:
         date = str(datetime.date.today() - datetime.timedelta(days=1))
 
     results = dict()
+    start = time.time()
+    run = f"etl-{date}"
 
     if use_sqlite:
         # Use SQLite staging for zero-downtime atomic updates
         print("Using SQLite staging for atomic updates")
-        results["downloads"] = get_daily_download_stats_sqlite(date)
+        with profile_stage(run, "download", profile):
+            results["downloads"] = get_daily_download_stats_sqlite(date)
         # __all__ stats are already computed in SQLite
     else:
         # Use original streaming approach (partial data visible during ETL)
         print("Using direct streaming (partial data may be visible)")
-        results["downloads"] = get_daily_download_stats(date)
-        results["__all__"] = update_all_package_stats(date)
+        with profile_stage(run, "download", profile):
+            results["downloads"] = get_daily_download_stats(date)
+        with etl_stage("all_packages"), profile_stage(run, "all_packages", profile):
+            results["__all__"] = update_all_package_stats(date)
+
+    results["loaded"] = is_loaded(results["downloads"])
+    if results["loaded"]:
+        with etl_stage("packages"), profile_stage(run, "packages", profile):
+            results["packages"] = update_package_dates(date)
 
     if update_recent:
-        results["recent"] = update_recent_stats()
+        with etl_stage("recent"), profile_stage(run, "recent", profile):
+            results["recent"] = update_recent_stats()
+        with etl_stage("top"), profile_stage(run, "top", profile):
+            results["top"] = update_top_stats()
 
-    results["cleanup"] = vacuum_analyze()
+    with etl_stage("vacuum"), profile_stage(run, "vacuum", profile):
+        results["cleanup"] = vacuum_analyze()
 
     if purge:
-        results["purge"] = purge_old_data(date)
+        with etl_stage("purge"), profile_stage(run, "purge", profile):
+            results["purge"] = purge_old_data(date)
+
+    # A run that did not load its date keeps the caches and validators of the current generation
+    if publish and results["loaded"]:
+        with etl_stage("publish"), profile_stage(run, "publish", profile):
+            results["publish"] = record_publish(date, etl.request.id)
+    elif publish:
+        print(f"Not publishing: the downloads of {date} did not load")
+    record_etl_stage("total", time.time() - start)
+    if results["loaded"]:
+        ETL_LAST_SUCCESS.set_to_current_time()
+
+    if update_recent and "publish" in results:
+        # Warm the caches and static pages for the new generation in separate tasks
+        results["warm"] = warm_cache.delay().id
+        results["prerender"] = prerender_pages.delay().id
 
     return results
 
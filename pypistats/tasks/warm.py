@@ -0,0 +1,125 @@
+"""Warm the response caches, package metadata and static pages."""
+
+import subprocess
+import sys
+import time
+from collections import Counter
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from pypistats.extensions import celery
+
+# Number of most downloaded packages to warm
+WARM_PACKAGES = 500
+
+# Number of responses computed at once
+WARM_CONCURRENCY = 4
+
+# Pages and API responses of each package
+PACKAGE_URLS = (
+    "/packages/{package}",
+    "/api/packages/{package}/recent",
+    "/api/packages/{package}/overall",
+    "/api/packages/{package}/python_major",
+    "/api/packages/{package}/python_minor",
+    "/api/packages/{package}/system",
+)
+
+# Responses that do not depend on a package
+URLS = ("/top", "/api/top/overall")
+
+
+def get_top_packages(limit):
+    """Get the most downloaded packages of the last month."""
+    from pypistats.models.download import RecentDownloadCount
+
+    downloads = (
+        RecentDownloadCount.query.filter_by(category="month")
+        .order_by(RecentDownloadCount.downloads.desc())
+        .limit(limit)
+        .all()
+    )
+    return [d.package for d in downloads]
+
+
+def warm_url(app, url):
+    """Compute the response of a url through its cached view, returning its cache status."""
+    from flask import g
+    from flask import request
+
+    try:
+        with app.test_request_context(url):
+            g.user = None
+            response = app.make_response(app.view_functions[request.endpoint](**request.view_args))
+    except Exception as e:
+        print(f"Error warming {url}: {e}")
+        return "ERROR"
+    if response.status_code != 200:
+        return "ERROR"
+    return response.headers.get("X-Cache", "UNCACHED")
+
+
+def warm_metadata(app, package):
+    """Fetch the PyPI metadata of a package if it is missing or old."""
+    from pypistats.metadata import get_metadata
+
+    if package == "__all__":
+        return
+    with app.app_context():
+        get_metadata(package, block=True)
+
+
+@celery.task
+def warm_cache(limit=WARM_PACKAGES, concurrency=WARM_CONCURRENCY):
+    """Fill the response caches with the responses of the most downloaded packages."""
+    from pypistats.generation import get_generation
+    from pypistats.run import app
+
+    print("Warm cache")
+    start = time.time()
+
+    with app.app_context():
+        generation = get_generation(refresh=True)
+        urls = list(URLS)
+        packages = get_top_packages(limit)
+        for package in packages:
+            urls.extend(url.format(package=package) for url in PACKAGE_URLS)
+
+    with ThreadPool(concurrency) as pool:
+        # Fetch the missing metadata first so the pages are complete
+        pool.map(partial(warm_metadata, app), packages)
+        statuses = Counter(pool.map(partial(warm_url, app), urls))
+
+    elapsed = round(time.time() - start, 2)
+    print(f"Warmed {statuses['MISS']} of {len(urls)} responses in {elapsed} seconds")
+    return {
+        "generation": generation.id,
+        "urls": len(urls),
+        "filled": statuses["MISS"],
+        "statuses": statuses,
+        "elapsed": elapsed,
+    }
+
+
+@celery.task
+def prerender_pages(limit=None):
+    """Pre-render the package pages of the latest generation into static files.
+
+    The pages are rendered by a pool of processes, which Celery worker
+    processes can not start themselves, so the generator runs as a separate
+    program.
+    """
+    command = [sys.executable, "-m", "pypistats.prerender"]
+    if limit is not None:
+        command += ["--limit", str(limit)]
+    return subprocess.run(command, check=True).returncode
+
+
+@celery.task
+def refresh_package_metadata(package):
+    """Fetch the PyPI metadata of a package into the cache."""
+    from pypistats.metadata import refresh_metadata
+    from pypistats.run import app
+
+    with app.app_context():
+        return refresh_metadata(package) is not None
@@ -0,0 +1,139 @@
+"""Per-request timing of database queries, serialization and external HTTP calls.
+
+With ``REQUEST_TIMING`` set, each response gets a ``Server-Timing`` header
+and requests slower than ``SLOW_REQUEST_THRESHOLD`` seconds are logged as a
+JSON line. Without it nothing is hooked up besides the timers in the code,
+which then only check for a timed request.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+
+from flask import before_render_template
+from flask import current_app
+from flask import g
+from flask import has_request_context
+from flask import request
+from flask import template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Durations reported in the Server-Timing header, with their descriptions
+DURATIONS = {"db": "Database", "serialize": "Rendering and JSON", "http": "External HTTP"}
+
+
+def get_timings():
+    """Get the timings of the current request, or None if it is not timed."""
+    return g.get("timings") if has_request_context() else None
+
+
+@contextmanager
+def timer(name):
+    """Add the time spent in the block to a duration of the current request."""
+    timings = get_timings()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] += time.perf_counter() - start
+
+
+def start_timing():
+    """Start timing the current request."""
+    g.timings = dict.fromkeys(DURATIONS, 0.0)
+    g.timings.update(start=time.perf_counter(), queries=0, rows=0)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Note the start of a query of a timed request."""
+    if get_timings() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Add a query to the timings of the request."""
+    timings = get_timings()
+    starts = conn.info.get("query_start")
+    if timings is None or not starts:
+        return
+    timings["db"] += time.perf_counter() - starts.pop()
+    timings["queries"] += 1
+    # Drivers report -1 when the number of rows is not known up front
+    if cursor.rowcount > 0:
+        timings["rows"] += cursor.rowcount
+
+
+def before_render(sender, template, context, **extra):
+    """Note the start of rendering a template."""
+    if get_timings() is not None:
+        g.render_start = time.perf_counter()
+
+
+def after_render(sender, template, context, **extra):
+    """Add the rendering of a template to the timings of the request."""
+    timings = get_timings()
+    start = g.pop("render_start", None)
+    if timings is not None and start is not None:
+        timings["serialize"] += time.perf_counter() - start
+
+
+def get_server_timing(timings, total):
+    """Format the timings of a request as a Server-Timing header."""
+    metrics = []
+    for name, description in DURATIONS.items():
+        if name == "db":
+            description = f"{timings['queries']} queries, {timings['rows']} rows"
+        metrics.append(f'{name};dur={timings[name] * 1000:.1f};desc="{description}"')
+    metrics.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(metrics)
+
+
+def log_slow_request(response, timings, total):
+    """Log the timings of a slow request as JSON."""
+    record = {
+        "event": "slow_request",
+        "method": request.method,
+        "path": request.full_path.rstrip("?"),
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "cache": response.headers.get("X-Cache"),
+        "total_ms": round(total * 1000, 1),
+        "queries": timings["queries"],
+        "rows": timings["rows"],
+    }
+    for name in DURATIONS:
+        record[f"{name}_ms"] = round(timings[name] * 1000, 1)
+    current_app.logger.warning(json.dumps(record))
+
+
+def finish_timing(response):
+    """Report the timings of the current request."""
+    timings = g.pop("timings", None)
+    if timings is None:
+        return response
+    total = time.perf_counter() - timings["start"]
+    response.headers["Server-Timing"] = get_server_timing(timings, total)
+    if total >= current_app.config["SLOW_REQUEST_THRESHOLD"]:
+        log_slow_request(response, timings, total)
+    return response
+
+
+def init_timing(app):
+    """Time the requests of an app if ``REQUEST_TIMING`` is set.
+
+    Register this before the other request hooks, so the timing covers them.
+    """
+    if not app.config["REQUEST_TIMING"]:
+        return
+    app.before_request(start_timing)
+    # The app's after request functions run last registered first, so this one runs last
+    app.after_request(finish_timing)
+    before_render_template.connect(before_render, app)
+    template_rendered.connect(after_render, app)
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
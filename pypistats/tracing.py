@@ -0,0 +1,208 @@
+"""Tracing of web requests, Celery tasks and ETL stages with OpenTelemetry.
+
+Spans are exported by the exporter named in ``TRACING_EXPORTER``:
+``console`` prints them, ``file`` appends them as JSON lines to
+``TRACING_FILE`` for offline use, ``otlp`` sends them to the collector at
+``OTEL_EXPORTER_OTLP_ENDPOINT`` and ``module:Class`` uses any other span
+exporter. Without an exporter, or without the OpenTelemetry SDK installed,
+spans cost next to nothing.
+
+The trace context goes along with the Celery tasks queued during a trace,
+so an ETL run triggered from the admin page is part of the admin request's
+trace.
+"""
+
+import importlib
+import os
+from contextlib import contextmanager
+from functools import wraps
+
+from celery.signals import before_task_publish
+from celery.signals import task_postrun
+from celery.signals import task_prerun
+from celery.signals import worker_process_init
+from flask import g
+from flask import request
+
+try:
+    from opentelemetry import context
+    from opentelemetry import propagate
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+try:
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+except ImportError:
+    TracerProvider = None
+
+# Name of the traced service
+SERVICE_NAME = "pypistats"
+
+# Spans of the running tasks of this process and the tokens to restore the context, by task id
+_task_spans = {}
+
+# Whether this process exports spans
+_state = {"enabled": False}
+
+
+class TaskGetter:
+    """Reads the trace context from the headers of a task.
+
+    Workers set the message headers as attributes of the task request, and
+    tasks run eagerly keep them in its ``headers``.
+    """
+
+    def get(self, carrier, key):
+        value = getattr(carrier, key, None)
+        if value is None:
+            value = (getattr(carrier, "headers", None) or {}).get(key)
+        return [value] if value is not None else None
+
+    def keys(self, carrier):
+        return []
+
+
+def get_exporter(name, path):
+    """Get the span exporter of a ``TRACING_EXPORTER`` value."""
+    if name == "console":
+        return ConsoleSpanExporter()
+    if name == "file":
+        out = open(path, "a", buffering=1)
+        return ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + os.linesep)
+    if name == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        return OTLPSpanExporter()
+    module, _, cls = name.partition(":")
+    return getattr(importlib.import_module(module), cls)()
+
+
+def init_tracing(exporter, path):
+    """Export the spans of this process, once per process.
+
+    Returns whether spans are exported.
+    """
+    if _state["enabled"] or not exporter:
+        return _state["enabled"]
+    if trace is None or TracerProvider is None:
+        print("Tracing needs the opentelemetry-sdk package")
+        return False
+    provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(get_exporter(exporter, path)))
+    trace.set_tracer_provider(provider)
+    _state["enabled"] = True
+    return True
+
+
+@contextmanager
+def span(name, **attributes):
+    """Trace a block as a span of the current trace."""
+    if trace is None:
+        yield None
+        return
+    with trace.get_tracer(__name__).start_as_current_span(name, attributes=attributes) as current:
+        yield current
+
+
+def traced(name):
+    """Trace each call of a function as a span."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def start_request_span():
+    """Start the span of the current request, continuing the trace of the client if it sent one."""
+    current = trace.get_tracer(__name__).start_span(
+        f"{request.method} {request.url_rule or request.path}",
+        context=propagate.extract(request.headers),
+        kind=trace.SpanKind.SERVER,
+        attributes={"http.method": request.method, "http.target": request.full_path.rstrip("?")},
+    )
+    g.trace_span = current
+    g.trace_token = context.attach(trace.set_span_in_context(current))
+
+
+def set_response_attributes(response):
+    """Add the status and cache result of the response to the span of the current request."""
+    current = g.get("trace_span")
+    if current is not None:
+        current.set_attribute("http.status_code", response.status_code)
+        if "X-Cache" in response.headers:
+            current.set_attribute("pypistats.cache", response.headers["X-Cache"])
+    return response
+
+
+def end_request_span(exc):
+    """End the span of the current request."""
+    current = g.pop("trace_span", None)
+    if current is None:
+        return
+    if exc is not None:
+        current.record_exception(exc)
+        current.set_status(trace.Status(trace.StatusCode.ERROR))
+    current.end()
+    context.detach(g.pop("trace_token"))
+
+
+def init_app(app):
+    """Trace the requests of an app if ``TRACING_EXPORTER`` is set."""
+    if not init_tracing(app.config["TRACING_EXPORTER"], app.config["TRACING_FILE"]):
+        return
+    app.before_request(start_request_span)
+    app.after_request(set_response_attributes)
+    app.teardown_request(end_request_span)
+
+
+@worker_process_init.connect
+def init_worker_tracing(**kwargs):
+    """Export the spans of a Celery worker process."""
+    from pypistats.config import Config
+
+    init_tracing(Config.TRACING_EXPORTER, Config.TRACING_FILE)
+
+
+@before_task_publish.connect
+def inject_trace_context(headers=None, **kwargs):
+    """Send the current trace context along with a queued task."""
+    if _state["enabled"] and headers is not None:
+        propagate.inject(headers)
+
+
+@task_prerun.connect
+def start_task_span(task_id=None, task=None, **kwargs):
+    """Start the span of a task, continuing the trace of the request or task that queued it."""
+    if not _state["enabled"] or task is None:
+        return
+    current = trace.get_tracer(__name__).start_span(
+        f"celery.task {task.name}",
+        context=propagate.extract(task.request, getter=TaskGetter()),
+        kind=trace.SpanKind.CONSUMER,
+        attributes={"celery.task_id": task_id},
+    )
+    _task_spans[task_id] = (current, context.attach(trace.set_span_in_context(current)))
+
+
+@task_postrun.connect
+def end_task_span(task_id=None, state=None, **kwargs):
+    """End the span of a task."""
+    entry = _task_spans.pop(task_id, None)
+    if entry is None:
+        return
+    current, token = entry
+    current.set_attribute("celery.state", state or "UNKNOWN")
+    if state == "FAILURE":
+        current.set_status(trace.Status(trace.StatusCode.ERROR))
+    current.end()
+    context.detach(token)
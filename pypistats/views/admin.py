@@ -1,16 +1,40 @@
 import os
 
+import sqlalchemy as sa
 from flask import Blueprint
+from flask import abort
+from flask import current_app
+from flask import jsonify
+from flask import redirect
 from flask import render_template
+from flask import request
+from flask import url_for
 from flask_wtf import FlaskForm
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import generate_latest
 from werkzeug.security import check_password_hash
 from werkzeug.security import generate_password_hash
 from wtforms import DateField
+from wtforms import StringField
 from wtforms.validators import DataRequired
+from wtforms.validators import Length
 
+from pypistats.cache import get_local_stats
+from pypistats.cache import get_stats
+from pypistats.dbstats import PRIMARY
+from pypistats.dbstats import collect_stats
+from pypistats.dbstats import diff_stats
+from pypistats.dbstats import get_report
+from pypistats.dbstats import get_servers
+from pypistats.dbstats import take_snapshot
 from pypistats.extensions import auth
+from pypistats.metrics import get_registry
+from pypistats.models.snapshot import DbStatsSnapshot
 from pypistats.tasks.pypi import etl
 
+# Snapshots listed on the database statistics page
+SNAPSHOTS_LISTED = 50
+
 users = {os.environ["BASIC_AUTH_USER"]: generate_password_hash(os.environ["BASIC_AUTH_PASSWORD"])}
 
 
@@ -27,6 +51,10 @@ class BackfillDateForm(FlaskForm):
     date = DateField("Date: ", validators=[DataRequired()])
 
 
+class SnapshotForm(FlaskForm):
+    label = StringField("Label: ", validators=[Length(max=128)])
+
+
 @blueprint.route("/admin", methods=("GET", "POST"))
 @auth.login_required
 def index():
@@ -36,3 +64,57 @@ def index():
         etl.apply_async(args=(str(date),))
         return render_template("admin.html", form=form, date=date)
     return render_template("admin.html", form=form)
+
+
+@blueprint.route("/admin/cache")
+@auth.login_required
+def cache():
+    return jsonify({"shared": get_stats(), "local": get_local_stats()})
+
+
+@blueprint.route("/metrics")
+@auth.login_required
+def metrics():
+    return generate_latest(get_registry()), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
+
+def get_snapshot_stats(snapshot_id, server):
+    """Get the statistics of a database server in a snapshot, or abort if they do not exist."""
+    snapshot = DbStatsSnapshot.get_by_id(snapshot_id)
+    if snapshot is None or server not in snapshot.data:
+        abort(404)
+    return snapshot.data[server]
+
+
+@blueprint.route("/admin/db", methods=("GET", "POST"))
+@auth.login_required
+def db_stats():
+    """Query, table and index statistics of a database server, or their change between two snapshots."""
+    servers = list(get_servers())
+    server = request.args.get("server", PRIMARY)
+    if server not in servers:
+        abort(404)
+    form = SnapshotForm()
+    if form.validate_on_submit():
+        snapshot = take_snapshot(form.label.data or "")
+        return redirect(url_for("admin.db_stats", server=server, since=snapshot.id))
+
+    since = request.args.get("since", type=int)
+    until = request.args.get("until", type=int)
+    try:
+        stats = get_snapshot_stats(until, server) if until else collect_stats(server)
+    except sa.exc.OperationalError as e:
+        current_app.logger.warning(f"Statistics of {server} unavailable: {str(e.orig).splitlines()[0]}")
+        abort(503)
+    if since:
+        stats = diff_stats(get_snapshot_stats(since, server), stats)
+    snapshots = DbStatsSnapshot.query.order_by(DbStatsSnapshot.id.desc()).limit(SNAPSHOTS_LISTED).all()
+    return render_template(
+        "dbstats.html",
+        form=form,
+        report=get_report(stats),
+        servers=servers,
+        snapshots=snapshots,
+        since=since,
+        until=until,
+    )
@@ -1,20 +1,59 @@
 """JSON API routes."""
 
+import datetime
+from itertools import groupby
+
 from flask import Blueprint
+from flask import Response
 from flask import abort
+from flask import current_app
 from flask import g
 from flask import jsonify
 from flask import render_template
 from flask import request
+from flask import stream_with_context
 
+from pypistats.cache import cached
+from pypistats.conditional import add_cache_headers
+from pypistats.conditional import not_modified
+from pypistats.extensions import db
 from pypistats.models.download import RECENT_CATEGORIES
 from pypistats.models.download import OverallDownloadCount
 from pypistats.models.download import PythonMajorDownloadCount
 from pypistats.models.download import PythonMinorDownloadCount
 from pypistats.models.download import RecentDownloadCount
 from pypistats.models.download import SystemDownloadCount
+from pypistats.models.download import TopDownloadCount
+from pypistats.names import canonicalize_name
+from pypistats.replicas import use_replica
+from pypistats.search import get_package_index
+from pypistats.search import is_known_package
+from pypistats.search import record_missing_package
+from pypistats.tracing import span
+from pypistats.tracing import traced
 
 blueprint = Blueprint("api", __name__, url_prefix="/api")
+blueprint.before_request(use_replica)
+blueprint.before_request(not_modified)
+blueprint.after_request(add_cache_headers)
+
+# Bucket sizes for aggregated time series
+AGGREGATE_INTERVALS = ("week", "month")
+
+# Layouts of the time series data
+DATA_FORMATS = ("rows", "columnar")
+
+# Maximum number of packages in an autocomplete response
+MAX_AUTOCOMPLETE_LIMIT = 50
+
+# Maximum number of packages in a bulk request
+MAX_BULK_PACKAGES = 250
+
+# Rows fetched per round trip when streaming bulk responses
+BULK_YIELD_PER = 10000
+
+# Maximum number of ranked packages in a top response
+MAX_TOP_LIMIT = 100
 
 
 @blueprint.route("/")
@@ -24,11 +63,13 @@ def api():
 
 
 @blueprint.route("/packages/<package>/recent")
+@cached
 def api_downloads_recent(package):
     """Get the recent downloads of a package."""
     # abort(503)
-    if package != "__all__":
-        package = package.replace(".", "-").replace("_", "-")
+    package = canonicalize_name(package)
+    if package not in get_package_index():
+        abort(404)
     category = request.args.get("period")
     if category is None:
         downloads = RecentDownloadCount.query.filter_by(package=package).all()
@@ -52,34 +93,22 @@ def api_downloads_recent(package):
 
 
 @blueprint.route("/packages/<package>/overall")
+@cached
 def api_downloads_overall(package):
     """Get the overall download time series of a package."""
     # abort(503)
-    if package != "__all__":
-        package = package.replace(".", "-").replace("_", "-")
+    package = canonicalize_name(package)
     mirrors = request.args.get("mirrors")
     if mirrors == "true":
-        downloads = (
-            OverallDownloadCount.query.filter_by(package=package, category="with_mirrors")
-            .order_by(OverallDownloadCount.date)
-            .all()
-        )
+        downloads = get_downloads(OverallDownloadCount, package, "with_mirrors")
     elif mirrors == "false":
-        downloads = (
-            OverallDownloadCount.query.filter_by(package=package, category="without_mirrors")
-            .order_by(OverallDownloadCount.date)
-            .all()
-        )
+        downloads = get_downloads(OverallDownloadCount, package, "without_mirrors")
     else:
-        downloads = (
-            OverallDownloadCount.query.filter_by(package=package)
-            .order_by(OverallDownloadCount.category, OverallDownloadCount.date)
-            .all()
-        )
+        downloads = get_downloads(OverallDownloadCount, package)
 
     response = {"package": package, "type": "overall_downloads"}
     if len(downloads) > 0:
-        response["data"] = [{"date": str(r.date), "category": r.category, "downloads": r.downloads} for r in downloads]
+        response.update(format_downloads(downloads))
     else:
         abort(404)
 
@@ -87,18 +116,21 @@ def api_downloads_overall(package):
 
 
 @blueprint.route("/packages/<package>/python_major")
+@cached
 def api_downloads_python_major(package):
     """Get the python major download time series of a package."""
     return generic_downloads(PythonMajorDownloadCount, package, "version", "python_major")
 
 
 @blueprint.route("/packages/<package>/python_minor")
+@cached
 def api_downloads_python_minor(package):
     """Get the python minor download time series of a package."""
     return generic_downloads(PythonMinorDownloadCount, package, "version", "python_minor")
 
 
 @blueprint.route("/packages/<package>/system")
+@cached
 def api_downloads_system(package):
     """Get the system download time series of a package."""
     return generic_downloads(SystemDownloadCount, package, "os", "system")
@@ -107,43 +139,320 @@ def api_downloads_system(package):
 def generic_downloads(model, package, arg, name):
     """Generate a generic response."""
     # abort(503)
-    if package != "__all__":
-        package = package.replace(".", "-").replace("_", "-")
+    package = canonicalize_name(package)
     category = request.args.get(arg)
     if category is not None:
-        downloads = model.query.filter_by(package=package, category=category.title()).order_by(model.date).all()
+        downloads = get_downloads(model, package, category.title())
     else:
-        downloads = model.query.filter_by(package=package).order_by(model.category, model.date).all()
+        downloads = get_downloads(model, package)
 
     response = {"package": package, "type": f"{name}_downloads"}
     if downloads is not None:
-        response["data"] = [{"date": str(r.date), "category": r.category, "downloads": r.downloads} for r in downloads]
+        response.update(format_downloads(downloads))
     else:
         abort(404)
 
     return jsonify(response)
 
 
-# TODO
-# @blueprint.route("/top/overall")
-# def api_top_packages():
-#     """Get the most downloaded packages by recency."""
-#     return "top overall"
-#
-#
-# @blueprint.route("/top/python_major")
-# def api_top_python_major():
-#     """Get the most downloaded packages by python major version."""
-#     return "top python_major"
-#
-#
-# @blueprint.route("/top/python_minor")
-# def api_top_python_minor():
-#     """Get the most downloaded packages by python minor version."""
-#     return "top python_minor"
-#
-#
-# @blueprint.route("/top/system")
-# def api_top_system():
-#     """Get the most downloaded packages by system."""
-#     return "top python_minor"
+def check_format_args():
+    """Reject a request with an unsupported format, aggregate or interval argument."""
+    if request.args.get("format", "rows") not in DATA_FORMATS:
+        abort(400)
+    aggregate = request.args.get("aggregate")
+    if aggregate is not None and aggregate != "sum":
+        abort(400)
+    interval = request.args.get("interval")
+    if aggregate is not None and interval is not None and interval not in AGGREGATE_INTERVALS:
+        abort(400)
+
+
+def get_date_range():
+    """Get the optional start and end dates from the query arguments."""
+    dates = []
+    for arg in ("start_date", "end_date"):
+        value = request.args.get(arg)
+        try:
+            dates.append(datetime.date.fromisoformat(value) if value is not None else None)
+        except ValueError:
+            abort(400)
+    return dates
+
+
+def get_downloads(model, package, category=None):
+    """Get the download time series of a package, or its sums if aggregated.
+
+    The date range is applied in the query, and aggregates are computed in the
+    database either over the whole range or per week or month bucket.
+    """
+    start_date, end_date = get_date_range()
+    if not is_known_package(package):
+        return []
+    with span("db.query", table=model.__tablename__):
+        downloads = query_downloads(model, package, category).all()
+    if not downloads and category is None and start_date is None and end_date is None:
+        record_missing_package(package)
+    return downloads
+
+
+def query_downloads(model, packages, category=None):
+    """Build the download time series query for a package or a list of packages.
+
+    Results for a list of packages are ordered and grouped by package first.
+    """
+    if isinstance(packages, str):
+        query = model.query.filter_by(package=packages)
+        group = []
+    else:
+        query = model.query.filter(model.package.in_(packages))
+        group = [model.package]
+    if category is not None:
+        query = query.filter_by(category=category)
+
+    start_date, end_date = get_date_range()
+    if start_date is not None:
+        query = query.filter(model.date >= start_date)
+    if end_date is not None:
+        query = query.filter(model.date <= end_date)
+
+    aggregate = request.args.get("aggregate")
+    if aggregate is None:
+        if category is not None:
+            return query.order_by(*group, model.date)
+        return query.order_by(*group, model.category, model.date)
+    elif aggregate != "sum":
+        abort(400)
+
+    downloads = db.cast(db.func.sum(model.downloads), db.BigInteger).label("downloads")
+    interval = request.args.get("interval")
+    if interval is None:
+        return (
+            query.with_entities(*group, model.category, downloads)
+            .group_by(*group, model.category)
+            .order_by(*group, model.category)
+        )
+    elif interval in AGGREGATE_INTERVALS:
+        date = db.cast(db.func.date_trunc(interval, model.date), db.Date).label("date")
+        return (
+            query.with_entities(*group, date, model.category, downloads)
+            .group_by(*group, date, model.category)
+            .order_by(*group, model.category, date)
+        )
+    abort(400)
+
+
+@traced("format_downloads")
+def format_downloads(downloads):
+    """Format the downloads for the response, including the aggregation if any."""
+    aggregate = request.args.get("aggregate")
+    if aggregate is None:
+        return format_data(downloads)
+
+    response = {"aggregate": aggregate}
+    start_date, end_date = get_date_range()
+    if start_date is not None:
+        response["start_date"] = start_date
+    if end_date is not None:
+        response["end_date"] = end_date
+    interval = request.args.get("interval")
+    if interval is None:
+        response["data"] = [{"category": r.category, "downloads": r.downloads} for r in downloads]
+    else:
+        response["interval"] = interval
+        response.update(format_data(downloads))
+    return response
+
+
+def format_data(downloads):
+    """Format the time series records in the requested response format."""
+    data_format = request.args.get("format", "rows")
+    if data_format == "rows":
+        return {"data": [{"date": r.date, "category": r.category, "downloads": r.downloads} for r in downloads]}
+    elif data_format == "columnar":
+        delta = request.args.get("delta") == "true"
+        return {"format": "columnar", "delta": delta, "data": get_columnar_data(downloads, delta)}
+    abort(400)
+
+
+def get_columnar_data(downloads, delta=False):
+    """Organize the records into a single date array and one count array per category.
+
+    Dates missing for a category are filled with zeros. With ``delta`` each
+    array holds its first count followed by the day over day differences.
+    """
+    dates = sorted({r.date for r in downloads})
+    index = {date: idx for idx, date in enumerate(dates)}
+    categories = {}
+    for r in downloads:
+        if r.category not in categories:
+            categories[r.category] = [0] * len(dates)
+        categories[r.category][index[r.date]] = r.downloads
+
+    if delta:
+        for values in categories.values():
+            values[1:] = [current - previous for previous, current in zip(values, values[1:])]
+
+    return {"dates": dates, "categories": categories}
+
+
+@blueprint.route("/autocomplete/<prefix>")
+@cached
+def api_autocomplete(prefix):
+    """Get the most downloaded packages starting with a prefix."""
+    prefix = canonicalize_name(prefix)
+    try:
+        limit = int(request.args.get("limit", 10))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= MAX_AUTOCOMPLETE_LIMIT:
+        abort(400)
+
+    completions = get_package_index().complete(prefix, limit=limit)
+    response = {"prefix": prefix, "type": "autocomplete"}
+    response["data"] = [{"package": package, "downloads": downloads} for package, downloads in completions]
+    return jsonify(response)
+
+
+@blueprint.route("/bulk/recent", methods=("GET", "POST"))
+@cached
+def api_bulk_recent():
+    """Get the recent downloads of multiple packages."""
+    index = get_package_index()
+    packages = [package for package in get_bulk_packages() if package in index]
+    category = request.args.get("period")
+    query = RecentDownloadCount.query.filter(RecentDownloadCount.package.in_(packages))
+    if category is None:
+        categories = RECENT_CATEGORIES
+    elif category in RECENT_CATEGORIES:
+        categories = [category]
+        query = query.filter_by(category=category)
+    else:
+        abort(404)
+
+    data = []
+    if not packages:
+        return jsonify({"type": "recent_downloads", "data": data})
+    for package, downloads in groupby(query.order_by(RecentDownloadCount.package), key=lambda r: r.package):
+        recent = {"last_" + rc: 0 for rc in categories}
+        for r in downloads:
+            recent["last_" + r.category] = r.downloads
+        data.append({"package": package, "data": recent})
+
+    return jsonify({"type": "recent_downloads", "data": data})
+
+
+@blueprint.route("/bulk/overall", methods=("GET", "POST"))
+@cached
+def api_bulk_overall():
+    """Get the overall download time series of multiple packages."""
+    # Checked before a streamed response has sent its status
+    check_format_args()
+    packages = [package for package in get_bulk_packages() if is_known_package(package)]
+    mirrors = request.args.get("mirrors")
+    if mirrors == "true":
+        query = query_downloads(OverallDownloadCount, packages, "with_mirrors")
+    elif mirrors == "false":
+        query = query_downloads(OverallDownloadCount, packages, "without_mirrors")
+    else:
+        query = query_downloads(OverallDownloadCount, packages)
+
+    def generate_packages():
+        if not packages:
+            return
+        for package, downloads in groupby(query.yield_per(BULK_YIELD_PER), key=lambda r: r.package):
+            yield {"package": package, **format_downloads(list(downloads))}
+
+    if request.args.get("stream") == "true":
+        # One package per line so large responses are never built in memory
+        lines = (current_app.json.dumps(package) + "\n" for package in generate_packages())
+        return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+
+    return jsonify({"type": "overall_downloads", "data": list(generate_packages())})
+
+
+def get_bulk_packages():
+    """Get the normalized package names of a bulk request.
+
+    Names are given as a comma separated ``packages`` argument or as a JSON
+    body ``{"packages": [...]}``, up to ``MAX_BULK_PACKAGES`` of them.
+    """
+    if request.is_json:
+        packages = (request.get_json(silent=True) or {}).get("packages")
+        if not isinstance(packages, list) or not all(isinstance(package, str) for package in packages):
+            abort(400)
+    else:
+        packages = request.values.get("packages", "").split(",")
+
+    normalized = []
+    for package in packages:
+        package = canonicalize_name(package.strip())
+        if package and package not in normalized:
+            normalized.append(package)
+
+    if not normalized or len(normalized) > MAX_BULK_PACKAGES:
+        abort(400)
+    return normalized
+
+
+@blueprint.route("/top/overall")
+@cached
+def api_top_packages():
+    """Get the most downloaded packages by recency."""
+    mirrors = request.args.get("mirrors")
+    if mirrors == "true":
+        return generic_top("overall", "with_mirrors")
+    return generic_top("overall", "without_mirrors")
+
+
+@blueprint.route("/top/python_major")
+@cached
+def api_top_python_major():
+    """Get the most downloaded packages by python major version."""
+    return generic_top("python_major", request.args.get("version"))
+
+
+@blueprint.route("/top/python_minor")
+@cached
+def api_top_python_minor():
+    """Get the most downloaded packages by python minor version."""
+    return generic_top("python_minor", request.args.get("version"))
+
+
+@blueprint.route("/top/system")
+@cached
+def api_top_system():
+    """Get the most downloaded packages by system."""
+    category = request.args.get("os")
+    return generic_top("system", category.title() if category is not None else None)
+
+
+def generic_top(name, category):
+    """Generate a top packages response from the precomputed rankings.
+
+    Pages are selected by rank through the primary key, so the cost does not
+    grow with the number of packages. Without a category every category of
+    the table is ranked.
+    """
+    period = request.args.get("period", "month")
+    if period not in RECENT_CATEGORIES:
+        abort(404)
+    try:
+        limit = int(request.args.get("limit", 20))
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= MAX_TOP_LIMIT or offset < 0:
+        abort(400)
+
+    query = TopDownloadCount.query.filter_by(name=name, period=period).filter(
+        TopDownloadCount.rank > offset, TopDownloadCount.rank <= offset + limit
+    )
+    if category is not None:
+        query = query.filter_by(category=category)
+    top_ = query.order_by(TopDownloadCount.category, TopDownloadCount.rank).all()
+
+    response = {"type": f"top_{name}_downloads", "period": period}
+    response["data"] = [
+        {"category": r.category, "rank": r.rank, "package": r.package, "downloads": r.downloads} for r in top_
+    ]
+    return jsonify(response)
@@ -1,11 +1,9 @@
 """General pages."""
 
 import datetime
-import re
 from collections import defaultdict
 from copy import deepcopy
 
-import requests
 from flask import Blueprint
 from flask import current_app
 from flask import g
@@ -16,14 +14,28 @@ from flask_wtf import FlaskForm
 from wtforms import StringField
 from wtforms.validators import DataRequired
 
+from pypistats.cache import cached
+from pypistats.conditional import add_cache_headers
+from pypistats.conditional import not_modified
+from pypistats.metadata import get_metadata
 from pypistats.models.download import RECENT_CATEGORIES
 from pypistats.models.download import OverallDownloadCount
 from pypistats.models.download import PythonMajorDownloadCount
 from pypistats.models.download import PythonMinorDownloadCount
 from pypistats.models.download import RecentDownloadCount
 from pypistats.models.download import SystemDownloadCount
+from pypistats.models.download import TopDownloadCount
+from pypistats.names import canonicalize_name
+from pypistats.prerender import serve_prerendered
+from pypistats.replicas import use_replica
+from pypistats.search import get_package_index
+from pypistats.tracing import span
 
 blueprint = Blueprint("general", __name__, template_folder="templates")
+blueprint.before_request(use_replica)
+blueprint.before_request(not_modified)
+blueprint.before_request(serve_prerendered)
+blueprint.after_request(add_cache_headers)
 
 
 MODELS = [OverallDownloadCount, PythonMajorDownloadCount, PythonMinorDownloadCount, SystemDownloadCount]
@@ -41,8 +53,8 @@ def index():
     form = PackageSearchForm()
     if form.validate_on_submit():
         package = form.name.data
-        return redirect(f"/search/{package.lower()}")
-    package_count = RecentDownloadCount.query.filter_by(category="month").count()
+        return redirect(f"/search/{canonicalize_name(package)}")
+    package_count = len(get_package_index())
     return render_template("index.html", form=form, user=g.user, package_count=package_count)
 
 
@@ -56,20 +68,12 @@ def health():
 @blueprint.route("/search/<package>", methods=("GET", "POST"))
 def search(package):
     """Render the home page."""
-    package = package.replace(".", "-")
+    package = canonicalize_name(package)
     form = PackageSearchForm()
     if form.validate_on_submit():
         package = form.name.data
         return redirect(f"/search/{package}")
-    results = (
-        RecentDownloadCount.query.filter(
-            RecentDownloadCount.package.like(f"{package}%"), RecentDownloadCount.category == "month"
-        )
-        .order_by(RecentDownloadCount.package)
-        .limit(20)
-        .all()
-    )
-    packages = [r.package for r in results]
+    packages = get_package_index().search(package, limit=20)
     if len(packages) == 1:
         package = packages[0]
         return redirect(f"/packages/{package}")
@@ -88,10 +92,16 @@ def faqs():
     return render_template("faqs.html", user=g.user)
 
 
+def get_package_query(model, package, start_date):
+    """Get the query of the records of a package in a download table since a date."""
+    return model.query.filter_by(package=package).filter(model.date >= start_date).order_by(model.date, model.category)
+
+
 @blueprint.route("/packages/<package>")
+@cached
 def package_page(package):
     """Render the package page."""
-    package = package.replace(".", "-")
+    package = canonicalize_name(package)
     # Recent download stats
     try:
         # Take the min of the lookback and 180
@@ -101,6 +111,8 @@ def package_page(package):
 
     start_date = str(datetime.date.today() - datetime.timedelta(lookback))
 
+    if package not in get_package_index():
+        return redirect(f"/search/{package}")
     recent_downloads = RecentDownloadCount.query.filter_by(package=package).all()
 
     if len(recent_downloads) == 0:
@@ -112,30 +124,14 @@ def package_page(package):
     # PyPI metadata
     metadata = None
     if package != "__all__":
-        try:
-            metadata = requests.get(f"https://pypi.python.org/pypi/{package}/json", timeout=5).json()
-            if metadata["info"].get("requires_dist", None):
-                requires, optional = set(), set()
-                for dependency in metadata["info"]["requires_dist"]:
-                    package_name = re.split(r"[^0-9a-zA-Z_.-]+", dependency.lower())[0]
-                    if "; extra ==" in dependency:
-                        optional.add(package_name)
-                    else:
-                        requires.add(package_name)
-                metadata["requires"] = sorted(requires)
-                metadata["optional"] = sorted(optional)
-        except Exception:
-            pass
+        with span("metadata", package=package):
+            metadata = get_metadata(package)
 
     # Get data from db
     model_data = []
     for model in MODELS:
-        records = (
-            model.query.filter_by(package=package)
-            .filter(model.date >= start_date)
-            .order_by(model.date, model.category)
-            .all()
-        )
+        with span("db.query", table=model.__tablename__):
+            records = get_package_query(model, package, start_date).all()
 
         if model == OverallDownloadCount:
             metrics = ["downloads"]
@@ -143,7 +139,9 @@ def package_page(package):
             metrics = ["downloads", "percentages"]
 
         for metric in metrics:
-            model_data.append({"metric": metric, "name": model.__tablename__, "data": data_function[metric](records)})
+            with span(data_function[metric].__name__, table=model.__tablename__):
+                data = data_function[metric](records)
+            model_data.append({"metric": metric, "name": model.__tablename__, "data": data})
 
     # Build the plots
     plots = []
@@ -191,7 +189,10 @@ def package_page(package):
 
         plots.append(plot)
 
-    return render_template("package.html", package=package, plots=plots, metadata=metadata, recent=recent, user=g.user)
+    with span("render", template="package.html"):
+        return render_template(
+            "package.html", package=package, plots=plots, metadata=metadata, recent=recent, user=g.user
+        )
 
 
 def get_download_data(records):
@@ -216,7 +217,7 @@ def get_download_data(records):
         if record.date != prev_date:
             for category in all_categories:
                 if category not in date_categories:
-                    data[category]["x"].append(str(prev_date))
+                    data[category]["x"].append(prev_date)
                     data[category]["y"].append(0)
 
             # Fill missing intermediate dates with zeros
@@ -225,7 +226,7 @@ def get_download_data(records):
 
             for date in date_list:
                 for category in all_categories:
-                    data[category]["x"].append(str(date))
+                    data[category]["x"].append(date)
                     data[category]["y"].append(0)
 
             # Reset
@@ -235,13 +236,13 @@ def get_download_data(records):
         # Track categories for this date
         date_categories.append(record.category)
 
-        data[record.category]["x"].append(str(record.date))
+        data[record.category]["x"].append(record.date)
         data[record.category]["y"].append(record.downloads)
     else:
         # Fill in missing final date with zeros
         for category in all_categories:
             if category not in date_categories:
-                data[category]["x"].append(str(records[-1].date))
+                data[category]["x"].append(records[-1].date)
                 data[category]["y"].append(0)
     return data
 
@@ -267,7 +268,7 @@ def get_proportion_data(records):
         if record.date != prev_date:
             total = sum(date_categories.values()) / 100
             for category in all_categories:
-                data[category]["x"].append(str(prev_date))
+                data[category]["x"].append(prev_date)
                 value = date_categories[category] / total
                 data[category]["y"].append(value)
                 data[category]["text"].append("{0:.2f}%".format(value) + " = {:,}".format(date_categories[category]))
@@ -282,11 +283,11 @@ def get_proportion_data(records):
         total = sum(date_categories.values()) / 100
         for category in all_categories:
             if category not in date_categories:
-                data[category]["x"].append(str(records[-1].date))
+                data[category]["x"].append(records[-1].date)
                 data[category]["y"].append(0)
                 data[category]["text"].append("{0:.2f}%".format(0) + " = {:,}".format(0))
             else:
-                data[category]["x"].append(str(records[-1].date))
+                data[category]["x"].append(records[-1].date)
                 value = date_categories[category] / total
                 data[category]["y"].append(value)
                 data[category]["text"].append("{0:.2f}%".format(value) + " = {:,}".format(date_categories[category]))
@@ -297,18 +298,22 @@ def get_proportion_data(records):
 data_function = {"downloads": get_download_data, "percentages": get_proportion_data}
 
 
+def get_top_query(period):
+    """Get the query of the 20 most downloaded packages of a period."""
+    return (
+        TopDownloadCount.query.filter_by(name="overall", period=period, category="without_mirrors")
+        .filter(TopDownloadCount.rank <= 20)
+        .order_by(TopDownloadCount.rank)
+    )
+
+
 @blueprint.route("/top")
+@cached
 def top():
     """Render the top packages page."""
     top_ = []
     for category in ("day", "week", "month"):
-        downloads = (
-            RecentDownloadCount.query.filter_by(category=category)
-            .filter(RecentDownloadCount.package != "__all__")
-            .order_by(RecentDownloadCount.downloads.desc())
-            .limit(20)
-            .all()
-        )
+        downloads = get_top_query(category).all()
         top_.append(
             {"category": category, "packages": [{"package": d.package, "downloads": d.downloads} for d in downloads]}
         )
@@ -11,9 +11,10 @@ from flask import session
 from flask import url_for
 
 from pypistats.extensions import github
-from pypistats.models.download import RecentDownloadCount
 from pypistats.models.user import MAX_FAVORITES
 from pypistats.models.user import User
+from pypistats.names import canonicalize_name
+from pypistats.search import get_package_index
 
 blueprint = Blueprint("user", __name__, template_folder="templates")
 
@@ -92,14 +93,15 @@ def user():
 @blueprint.route("/user/packages/<package>")
 def user_package(package):
     """Handle adding and deleting packages to user's list."""
+    package = canonicalize_name(package)
     if g.user:
         # Ensure package is valid.
-        downloads = RecentDownloadCount.query.filter_by(package=package).all()
+        known = package in get_package_index()
 
         # Handle add/remove to favorites
         if g.user.favorites is None:
             # Ensure package is valid before adding
-            if len(downloads) == 0:
+            if not known:
                 return abort(400)
             g.user.favorites = [package]
             g.user.update()
@@ -116,7 +118,7 @@ def user_package(package):
         else:
             if len(g.user.favorites) < MAX_FAVORITES:
                 # Ensure package is valid before adding
-                if len(downloads) == 0:
+                if not known:
                     return abort(400)
                 favorites = g.user.favorites
                 favorites.append(package)
@@ -0,0 +1,96 @@
+"""Fixtures of the tests."""
+
+import datetime
+import json
+import os
+
+import pytest
+import requests
+
+# The admin views read their credentials on import
+os.environ.setdefault("BASIC_AUTH_USER", "admin")
+os.environ.setdefault("BASIC_AUTH_PASSWORD", "password")
+
+from pypistats import cache
+from pypistats import generation
+from pypistats.application import create_app
+from pypistats.config import TestConfig
+from pypistats.extensions import db
+from pypistats.models.download import RecentDownloadCount
+from pypistats.models.publish import Publish
+
+
+class UnitTestConfig(TestConfig):
+    """Configuration of the tests, on an in-memory database and cache."""
+
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    SQLALCHEMY_BINDS = {}
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """An application with the publish and recent tables, and empty caches and generation."""
+    monkeypatch.setattr(cache, "_clients", {})
+    monkeypatch.setattr(cache, "_local", {"cache": None})
+    monkeypatch.setattr(generation, "_latest", {"generation": None, "checked": None})
+    app = create_app(UnitTestConfig)
+    # Each request pushes a context of its own, so that nothing is shared through g
+    with app.app_context():
+        Publish.__table__.create(db.engine)
+        RecentDownloadCount.__table__.create(db.engine)
+    return app
+
+
+@pytest.fixture
+def redis_client(app):
+    """The in-memory redis client of the response cache."""
+    with app.app_context():
+        return cache.get_client()
+
+
+@pytest.fixture
+def publish(app):
+    """Publish a new generation of the data, seen by the next request."""
+
+    def publish():
+        with app.app_context():
+            Publish.create(date=datetime.date.today())
+        generation._latest["checked"] = None
+
+    return publish
+
+
+class PyPIStub:
+    """Stub of the PyPI JSON API at ``PYPI_URL``, serving the metadata of the packages added to it."""
+
+    def __init__(self, url):
+        self.url = url
+        self.packages = {}
+        self.errors = set()
+        self.requests = []
+
+    def add(self, package, **info):
+        self.packages[package] = {"info": dict({"version": "1.0", "requires_dist": None}, **info)}
+
+    def get(self, url, timeout=None):
+        assert url.startswith(f"{self.url}/") and url.endswith("/json")
+        package = url[len(self.url) + 1 : -len("/json")]
+        self.requests.append(package)
+        response = requests.Response()
+        response.url = url
+        if package in self.errors:
+            response.status_code = 503
+        elif package in self.packages:
+            response.status_code = 200
+            response._content = json.dumps(self.packages[package]).encode()
+        else:
+            response.status_code = 404
+        return response
+
+
+@pytest.fixture
+def pypi(app, monkeypatch):
+    """The stub of PyPI answering the requests of the application."""
+    stub = PyPIStub(app.config["PYPI_URL"])
+    monkeypatch.setattr(requests, "get", stub.get)
+    return stub
@@ -0,0 +1,159 @@
+"""Tests of the response caches."""
+
+import pytest
+import redis
+from flask import g
+from flask import make_response
+from flask import session
+
+from pypistats.cache import cached
+from pypistats.cache import get_client
+
+
+@pytest.fixture
+def calls(app):
+    """The number of times a cached view was computed, served at /cached."""
+    calls = []
+
+    @app.route("/cached")
+    @cached
+    def cached_view():
+        calls.append(1)
+        return f"computed {len(calls)}"
+
+    return calls
+
+
+@pytest.fixture
+def client(app, calls):
+    return app.test_client()
+
+
+def test_miss(client, calls):
+    response = client.get("/cached")
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.get_data(as_text=True) == "computed 1"
+    assert len(calls) == 1
+
+
+def test_hit_local(client, calls):
+    client.get("/cached")
+    response = client.get("/cached")
+    assert response.headers["X-Cache"] == "HIT-LOCAL"
+    assert response.get_data(as_text=True) == "computed 1"
+    assert len(calls) == 1
+
+
+def test_hit_shared(app, client, calls):
+    app.config["LOCAL_CACHE_SIZE"] = 0
+    client.get("/cached")
+    response = client.get("/cached")
+    assert response.headers["X-Cache"] == "HIT"
+    assert response.get_data(as_text=True) == "computed 1"
+    assert len(calls) == 1
+
+
+def test_hit_gzip(client, calls):
+    client.get("/cached")
+    response = client.get("/cached", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("key, value", [("user_id", 1), ("_flashes", [("message", "Saved")])])
+def test_bypass_personal_pages(client, calls, key, value):
+    client.get("/cached")
+    with client.session_transaction() as session:
+        session[key] = value
+    response = client.get("/cached")
+    assert "X-Cache" not in response.headers
+    assert response.get_data(as_text=True) == "computed 2"
+    assert len(calls) == 2
+
+
+def test_bypass_new_session(app):
+    @app.route("/session")
+    @cached
+    def session_view():
+        session["seen"] = True
+        return "computed"
+
+    client = app.test_client()
+    client.get("/session")
+    response = app.test_client().get("/session")
+    assert response.headers["X-Cache"] == "MISS"
+    assert "Set-Cookie" in response.headers
+
+
+def test_bypass_cookie(app):
+    @app.route("/cookie")
+    @cached
+    def cookie_view():
+        response = make_response("computed")
+        response.set_cookie("theme", "dark")
+        return response
+
+    app.test_client().get("/cookie")
+    response = app.test_client().get("/cookie")
+    assert response.headers["X-Cache"] == "MISS"
+
+
+def test_search_form_not_shared(app, client):
+    # Set by pypistats.run for every request
+    app.before_request(lambda: setattr(g, "user", None))
+    app.config["WTF_CSRF_ENABLED"] = True
+    first = client.get("/search/requests")
+    second = app.test_client().get("/search/requests")
+    assert "X-Cache" not in second.headers
+    assert "Set-Cookie" in second.headers
+    assert first.get_data() != second.get_data()
+
+
+def test_new_generation(app, client, calls, publish):
+    client.get("/cached")
+    publish()
+    response = client.get("/cached")
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.get_data(as_text=True) == "computed 2"
+    response = client.get("/cached")
+    assert response.headers["X-Cache"] == "HIT-LOCAL"
+    assert len(calls) == 2
+
+
+def test_new_generation_shared(app, client, calls, publish, redis_client):
+    app.config["LOCAL_CACHE_SIZE"] = 0
+    client.get("/cached")
+    publish()
+    response = client.get("/cached")
+    assert response.headers["X-Cache"] == "MISS"
+    assert len(calls) == 2
+    assert len(redis_client.keys("pypistats:cache:*:cached_view:*")) == 2
+
+
+def test_lock_released(client, calls, redis_client):
+    client.get("/cached")
+    assert redis_client.keys("*:lock") == []
+
+
+def test_lock_of_another_request_kept(app, redis_client):
+    @app.route("/expired")
+    @cached
+    def expired_view():
+        # The lock expired during the computation and another request took it
+        [lock] = get_client().keys("*:lock")
+        get_client().set(lock, "other")
+        return "computed"
+
+    app.test_client().get("/expired")
+    [lock] = redis_client.keys("*:lock")
+    assert redis_client.get(lock) == b"other"
+
+
+def test_lock_release_error(client, calls, monkeypatch, redis_client):
+    def register_script(script):
+        raise redis.ConnectionError("Connection lost")
+
+    monkeypatch.setattr(redis_client, "register_script", register_script)
+    response = client.get("/cached")
+    assert response.headers["X-Cache"] == "MISS"
+    assert len(calls) == 1
@@ -0,0 +1,44 @@
+"""Tests of the HTTP cache headers."""
+
+import pytest
+from flask import g
+
+
+@pytest.fixture
+def client(app, publish):
+    """A client of a site with a published generation of the data and the CSRF protection of production."""
+    # Set by pypistats.run for every request
+    app.before_request(lambda: setattr(g, "user", None))
+    app.config["WTF_CSRF_ENABLED"] = True
+    publish()
+    return app.test_client()
+
+
+def test_public(client):
+    response = client.get("/about")
+    assert response.cache_control.public
+    assert response.cache_control.max_age <= 3600
+    assert response.headers["ETag"]
+
+
+def test_not_modified(client):
+    etag = client.get("/about").headers["ETag"]
+    response = client.get("/about", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_search_form_private(client):
+    response = client.get("/search/requests")
+    assert "Set-Cookie" in response.headers
+    assert not response.cache_control.public
+    assert response.cache_control.private
+    assert "ETag" not in response.headers
+
+
+def test_signed_in_private(client):
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+    response = client.get("/about")
+    assert not response.cache_control.public
+    assert response.cache_control.no_cache
+    assert "ETag" not in response.headers
@@ -0,0 +1,115 @@
+"""Tests of the PyPI metadata of the package pages."""
+
+import json
+import time
+
+import pytest
+from flask import g
+
+from pypistats.metadata import METADATA_KEY
+from pypistats.metadata import get_metadata
+from pypistats.metadata import parse_metadata
+from pypistats.metadata import refresh_metadata
+from pypistats.tasks.warm import refresh_package_metadata
+
+
+@pytest.fixture
+def queued(monkeypatch):
+    """The packages whose metadata refresh was queued."""
+    queued = []
+    monkeypatch.setattr(refresh_package_metadata, "apply_async", lambda args, **options: queued.append(args[0]))
+    return queued
+
+
+@pytest.fixture
+def request_context(app):
+    """The context of a package page request, in which views get metadata."""
+    with app.test_request_context("/packages/requests"):
+        yield
+
+
+def store(redis_client, package, metadata, age):
+    entry = json.dumps({"fetched": time.time() - age, "metadata": metadata})
+    redis_client.set(METADATA_KEY.format(package=package), entry)
+
+
+def test_parse_metadata():
+    data = {
+        "info": {
+            "version": "2.32.3",
+            "summary": "HTTP for Humans.",
+            "downloads": {"last_day": -1},
+            "requires_dist": [
+                "charset-normalizer<4,>=2",
+                "idna<4,>=2.5",
+                "PySocks!=1.5.7,>=1.5.6; extra == 'socks'",
+            ],
+        }
+    }
+    metadata = parse_metadata(data)
+    assert metadata["info"]["version"] == "2.32.3"
+    assert "downloads" not in metadata["info"]
+    assert metadata["requires"] == ["charset-normalizer", "idna"]
+    assert metadata["optional"] == ["pysocks"]
+
+
+def test_refresh(app, pypi, redis_client):
+    pypi.add("requests", version="2.32.3")
+    with app.app_context():
+        metadata = refresh_metadata("requests")
+    assert metadata["info"]["version"] == "2.32.3"
+    assert json.loads(redis_client.get(METADATA_KEY.format(package="requests")))["metadata"] == metadata
+
+
+def test_refresh_error(app, pypi, redis_client):
+    pypi.errors.add("requests")
+    with app.app_context():
+        assert refresh_metadata("requests") is None
+    assert redis_client.get(METADATA_KEY.format(package="requests")) is None
+
+
+def test_fresh(app, pypi, queued, redis_client, request_context):
+    store(redis_client, "requests", {"info": {"version": "2.32.3"}}, age=60)
+    assert get_metadata("requests") == {"info": {"version": "2.32.3"}}
+    assert pypi.requests == []
+    assert queued == []
+
+
+def test_stale(app, pypi, queued, redis_client, request_context):
+    store(redis_client, "requests", {"info": {"version": "2.32.2"}}, age=app.config["METADATA_MAX_AGE"] + 60)
+    assert get_metadata("requests") == {"info": {"version": "2.32.2"}}
+    assert get_metadata("requests") == {"info": {"version": "2.32.2"}}
+    assert queued == ["requests"]
+    assert pypi.requests == []
+    assert not g.get("skip_cache")
+
+
+def test_stale_block(app, pypi, queued, redis_client, request_context):
+    pypi.add("requests", version="2.32.3")
+    store(redis_client, "requests", {"info": {"version": "2.32.2"}}, age=app.config["METADATA_MAX_AGE"] + 60)
+    assert get_metadata("requests", block=True)["info"]["version"] == "2.32.3"
+    assert queued == []
+
+
+def test_missing(pypi, queued, request_context):
+    assert get_metadata("requests") is None
+    assert queued == ["requests"]
+    assert pypi.requests == []
+    assert g.skip_cache
+
+
+def test_not_on_pypi(pypi, queued, request_context):
+    assert get_metadata("unknown-package", block=True) is None
+    assert pypi.requests == ["unknown-package"]
+    # Remembered as unknown until it is old
+    assert get_metadata("unknown-package", block=True) is None
+    assert pypi.requests == ["unknown-package"]
+    assert queued == []
+
+
+def test_without_cache(app, pypi, queued, request_context):
+    app.config["CACHE_URL"] = ""
+    pypi.add("requests", version="2.32.3")
+    assert get_metadata("requests") is None
+    assert pypi.requests == []
+    assert get_metadata("requests", block=True)["info"]["version"] == "2.32.3"
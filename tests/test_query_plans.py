@@ -0,0 +1,56 @@
+"""Tests of the query plans of the hot read queries, against a database seeded by check_query_plans.py."""
+
+import datetime
+import os
+
+import pytest
+import sqlalchemy as sa
+
+from check_query_plans import BUDGETS
+from check_query_plans import CHECKED_PACKAGE
+from check_query_plans import check
+from check_query_plans import describe
+from check_query_plans import explain
+from check_query_plans import get_queries
+from pypistats.application import create_app
+from pypistats.config import TestConfig
+from pypistats.extensions import db
+
+DATABASE_URL = os.environ.get("DATABASE_URL", "")
+
+pytestmark = pytest.mark.skipif(
+    not DATABASE_URL.startswith("postgresql"), reason="DATABASE_URL is not a PostgreSQL database"
+)
+
+
+class PlansConfig(TestConfig):
+    """Configuration of the plan checks, on the primary only."""
+
+    SQLALCHEMY_DATABASE_URI = DATABASE_URL
+    SQLALCHEMY_BINDS = {}
+
+
+@pytest.fixture(scope="module")
+def queries():
+    """The checked queries by name, on an analyzed seeded database."""
+    app = create_app(PlansConfig)
+    with app.app_context():
+        with db.engine.connect() as connection:
+            seeded = connection.execute(
+                sa.text("SELECT 1 FROM overall WHERE package = :package LIMIT 1"), {"package": CHECKED_PACKAGE}
+            ).first()
+            if seeded is None:
+                pytest.skip("The database is not seeded, run check_query_plans.py --seed on a scratch database")
+            connection.exec_driver_sql("ANALYZE")
+            connection.commit()
+        end_date = datetime.date.today() - datetime.timedelta(days=1)
+        yield get_queries(end_date)
+
+
+@pytest.mark.parametrize("name", BUDGETS)
+def test_query_plan(queries, name):
+    sql, params = queries[name]
+    with db.engine.connect() as connection:
+        plan = explain(connection, sql, params)
+    problems = check(name, plan)
+    assert not problems, "\n".join(problems + describe(plan["Plan"]))
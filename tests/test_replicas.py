@@ -0,0 +1,104 @@
+"""Tests of the routing of reads to the read replicas, against a PostgreSQL primary and a streaming replica of it."""
+
+import os
+
+import pytest
+import sqlalchemy as sa
+
+from pypistats import generation
+from pypistats import replicas
+from pypistats.application import create_app
+from pypistats.config import TestConfig
+from pypistats.extensions import db
+from pypistats.models.download import OverallDownloadCount
+from pypistats.models.download import RecentDownloadCount
+from pypistats.models.publish import Publish
+from pypistats.replicas import check_replica
+from pypistats.replicas import get_replica_binds
+from pypistats.replicas import use_replica
+
+DATABASE_URL = os.environ.get("DATABASE_URL", "")
+DATABASE_REPLICA_URLS = os.environ.get("DATABASE_REPLICA_URLS", "")
+
+pytestmark = pytest.mark.skipif(
+    not DATABASE_URL.startswith("postgresql") or not DATABASE_REPLICA_URLS.startswith("postgresql"),
+    reason="DATABASE_URL and DATABASE_REPLICA_URLS are not a PostgreSQL primary and replica",
+)
+
+
+class ReplicaConfig(TestConfig):
+    """Configuration of the routing tests, on the primary and replicas of the environment."""
+
+    SQLALCHEMY_DATABASE_URI = DATABASE_URL
+    SQLALCHEMY_BINDS = get_replica_binds(DATABASE_REPLICA_URLS)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """An application on the primary and replicas, with no replica checked yet."""
+    monkeypatch.setattr(replicas, "_replicas", {"healthy": [], "checked": None})
+    monkeypatch.setattr(generation, "_latest", {"generation": None, "checked": None})
+    return create_app(ReplicaConfig)
+
+
+@pytest.fixture
+def replica_request(app):
+    """The context of a request whose reads may go to a replica."""
+    with app.test_request_context("/api/packages/requests/overall"):
+        use_replica()
+        yield
+        db.session.rollback()
+
+
+def read_from_replica(model):
+    """Check whether a query of the table of a model is answered by a replica."""
+    query = db.session.query(sa.func.pg_is_in_recovery(), sa.func.count()).select_from(model).filter(sa.false())
+    return query.one()[0]
+
+
+def test_reads_from_replica(replica_request):
+    assert read_from_replica(OverallDownloadCount)
+
+
+def test_primary_tables(replica_request):
+    assert not read_from_replica(Publish)
+
+
+def test_outside_replica_requests(app):
+    with app.test_request_context("/admin"):
+        assert not read_from_replica(OverallDownloadCount)
+
+
+def test_pending_changes(replica_request):
+    db.session.add(RecentDownloadCount(package="pypistats-test", category="day", downloads=1))
+    assert not read_from_replica(RecentDownloadCount)
+
+
+def test_flushed_changes(replica_request):
+    db.session.add(RecentDownloadCount(package="pypistats-test", category="day", downloads=1))
+    db.session.flush()
+    assert not read_from_replica(RecentDownloadCount)
+    db.session.rollback()
+    assert read_from_replica(RecentDownloadCount)
+
+
+def test_lagging_replica(app, replica_request):
+    app.config["REPLICA_MAX_LAG"] = -1
+    assert not read_from_replica(OverallDownloadCount)
+
+
+def test_check_replica(app):
+    with app.app_context():
+        engine = db.engines["replica0"]
+        published = generation.get_generation().id
+        assert check_replica(engine, published)
+        # A replica without the latest publish
+        assert not check_replica(engine, published + 1)
+        app.config["REPLICA_MAX_LAG"] = -1
+        assert not check_replica(engine, published)
+
+
+def test_check_unavailable_replica(app):
+    with app.app_context():
+        engine = sa.create_engine(sa.make_url(DATABASE_URL).set(host="localhost", port=1))
+        assert not check_replica(engine, 0)